@@ -1,17 +1,192 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 """Application."""
+import copy
 import errno
+import json
+import os
+import signal
+import socket
 import sys
+import threading
 
+import lib.admission as Admission
+import lib.cluster as Cluster
 import lib.config as Config
+import lib.control as Control
 import lib.drupal as Drupal
 import lib.logger as Logger
 import lib.profile as Profile
+import lib.report as Report
 import lib.identifier as Identifier
 
 # variables
 cfg_file = "./config.yml"
+# set by SIGHUP in long-running mode
+reload_requested = threading.Event()
+wakeup = threading.Event()
+
+
+def request_reload(signum, frame):
+    """SIGHUP handler: reload the configuration before the next run."""
+    reload_requested.set()
+    wakeup.set()
+
+
+def setup_profile(cfg, pf, logger):
+    """Check drupal and load the profile from the current configuration."""
+    # drupal checks
+    drupal = Drupal.Drupal(cfg.get_value("drupal.root"),
+                           cfg.get_value("drupal.uri"))
+    logger.info("Checking if drush binary is installed ...")
+    drupal.check_drush_bin()
+    logger.info("Checking that '%s' is a valid drupal instance ...",
+                drupal.root)
+    drupal.check_instance()
+    pf.drupal = drupal
+    pf.log_dir = cfg.get_value("log.directory")
+
+    # host-local runtime files (control socket, admission slots)
+    runtime_dir = cfg.get_value("runtime_dir") or cfg.get_value("state_dir")
+    if not os.path.isdir(runtime_dir):
+        os.makedirs(runtime_dir)
+
+    # limit the drush operations running at once on the host
+    if cfg.get_value("admission") is not None:
+        pf.admission = Admission.AdmissionController(
+            runtime_dir, logger,
+            cfg.get_value("admission.max_operations") or 0,
+            cfg.get_value("admission.max_load"),
+            cfg.get_value("admission.probe.command"),
+            cfg.get_value("admission.probe.threshold"),
+            cfg.get_value("admission.poll_interval") or 5)
+    else:
+        pf.admission = None
+
+    # load given profile
+    logger.info("Loading profile ...")
+    pf.load(cfg, cfg.profile)
+    logger.info("Setting alerters for the profile ...")
+    pf.set_alerters(cfg.config)
+
+    # fan out: drupal targets of the profile
+    targets = []
+    for target in pf.config.get("targets") or []:
+        target_drupal = Drupal.Drupal(target["root"], target["uri"])
+        target_drupal.check_drush_bin()
+        logger.info("Checking that target '%s' (%s) is a valid drupal "
+                    "instance ...", target["name"], target_drupal.root)
+        target_drupal.check_instance()
+        targets.append({"name": target["name"], "drupal": target_drupal})
+    pf.set_targets(targets)
+
+    # profile checkings
+    logger.info("Checking source and target directories ...")
+    pf.check_config_dir("source.directory")
+    pf.check_config_dir("target.directory")
+    logger.info("Checking target config files ...")
+    pf.check_config_file("target.objects")
+    pf.check_config_file("target.config")
+
+
+def process(pf, logger):
+    """Queue and process the new source files."""
+    logger.info("Get current profile state ...")
+    pf.get_state()
+    logger.info("Queuing ...")
+    todo_jobs = pf.queuing()
+    logger.info("%s files has been added in the [todo] queue",
+                todo_jobs)
+    logger.info("Processing the [todo] queue ...")
+    pf.process_todo_q()
+
+
+def claim(lease, pf, logger):
+    """
+    Return True if the current process can process the profile.
+
+    In multi-node mode the profile lease must be held.
+    """
+    if lease is None:
+        return True
+    if not lease.acquire():
+        logger.info("profile '%s' is claimed by '%s'",
+                    pf.alias, lease.owner or "other nodes")
+        return False
+    if lease.took_over:
+        logger.warning("profile '%s' taken over from an expired node",
+                       pf.alias)
+        pf.clear_stale_lock()
+        lease.took_over = False
+
+    return True
+
+
+def start_control(pf, logger):
+    """
+    Start the control socket, return None if already in use.
+
+    A socket in use means that another process runs the profile: the
+    profile is busy.
+    """
+    logger.info("Starting the control socket ...")
+    try:
+        control = Control.ControlServer(pf.socket_file, pf)
+        control.start()
+    except Control.ControlError as e:
+        logger.warning("profile '%s' is busy: %s", pf.alias, e)
+        control = None
+
+    return control
+
+
+def report(cfg, logger):
+    """Print the run history report of the profile (or of all profiles)."""
+    if cfg.profile is None:
+        profiles = [cfg.profiles["alias"][alias]
+                    for alias in sorted(cfg.profiles["alias"])]
+    else:
+        profiles = [cfg.get_profile(cfg.profile)]
+        if profiles[0] is None:
+            raise Profile.ProfileLoadError("profile '%s' not found" %
+                                           cfg.profile)
+
+    for profile in profiles:
+        history = Report.History(cfg.get_value("state_dir"),
+                                 cfg.get_value("log.directory"),
+                                 profile["alias"], profile["operations"])
+        history.load()
+        added = history.update()
+        if added > 0:
+            logger.info("%s archives added to '%s' history",
+                        added, profile["alias"])
+            history.save()
+        for line in Report.Report(history).render():
+            print line
+
+
+def reload_profile(cfg, pf, logger):
+    """
+    Reload the configuration and rebuild the profile.
+
+    The new configuration and profile are fully checked before they
+    replace the current ones: on any error the current ones are kept.
+    Return the configuration and the profile to use.
+    """
+    logger.info("Reloading configuration file (%s) ...", cfg.file)
+    new_cfg = copy.copy(cfg)
+    new_pf = Profile.Profile(None, cfg.get_value("log.directory"), logger)
+    try:
+        new_cfg.reload()
+        setup_profile(new_cfg, new_pf, logger)
+    # the running importer must survive any error of the new configuration
+    except Exception as e:
+        logger.error("configuration not reloaded: %s", e)
+        return cfg, pf
+    new_pf.inherit(pf)
+    Logger.set_profile(logger, new_pf)
+
+    return new_cfg, new_pf
 
 
 def main():
@@ -23,44 +198,65 @@ def main():
         cfg = Config.Config(cfg_file)
         cfg.parse_args()
         # load configuration
-        logger.info("Loading configuration file (%s) ..." % cfg_file)
+        logger.info("Loading configuration file (%s) ...", cfg_file)
         cfg.load()
 
-        # drupal checks
-        drupal = Drupal.Drupal(cfg.get_value("drupal.root"),
-                               cfg.get_value("drupal.uri"))
-        logger.info("Checking if drush binary is installed ...")
-        drupal.check_drush_bin()
-        logger.info("Checking that '%s' is a valid drupal instance ..." %
-                    drupal.root)
-        drupal.check_instance()
+        if cfg.command == "report":
+            report(cfg, logger)
+            sys.exit(0)
+
+        # control client: query the running profile and exit
+        if cfg.control is not None:
+            pf = Profile.Profile(None, cfg.get_value("log.directory"), logger)
+            pf.load(cfg, cfg.profile)
+            response = Control.send_command(pf.socket_file, cfg.control)
+            print json.dumps(response, indent=4)
+            sys.exit(0 if response["result"] == "ok" else 1)
 
         # init profile
-        pf = Profile.Profile(drupal, cfg.get_value("log.directory"), logger)
-
-        # load given profile
-        logger.info("Loading profile ...")
-        pf.load(cfg.config, cfg.profile)
-        logger.info("Setting alerters for the profile ...")
-        pf.set_alerters(cfg.config)
-
-        # profile checkings
-        logger.info("Checking source and target directories ...")
-        pf.check_config_dir("source.directory")
-        pf.check_config_dir("target.directory")
-        logger.info("Checking target config files ...")
-        pf.check_config_file("target.objects")
-        pf.check_config_file("target.config")
-
-        # process
-        logger.info("Get current profile state ...")
-        pf.get_state()
-        logger.info("Queuing ...")
-        todo_jobs = pf.queuing()
-        logger.info("%s files has been added in the [todo] queue" %
-                    todo_jobs)
-        logger.info("Processing the [todo] queue ...")
-        pf.process_todo_q()
+        pf = Profile.Profile(None, cfg.get_value("log.directory"), logger)
+        if cfg.get_value("log.structured"):
+            Logger.configure_structured(logger, pf,
+                                        cfg.get_value("log.directory"),
+                                        cfg.get_value("log.level") or "DEBUG")
+        setup_profile(cfg, pf, logger)
+
+        # multi-node mode: the profile is processed by one node at a time
+        lease = None
+        if cfg.get_value("cluster.directory") is not None:
+            lease = Cluster.Lease(cfg.get_value("cluster.directory"),
+                                  pf.alias,
+                                  cfg.get_value("cluster.lease_ttl") or 60,
+                                  cfg.get_value("cluster.max_profiles") or 0)
+            pf.lease = lease
+
+        # long-running mode: the configuration is reloaded on SIGHUP
+        # or when the file changes
+        if cfg.interval is not None:
+            signal.signal(signal.SIGHUP, request_reload)
+        control = None
+        try:
+            while True:
+                if claim(lease, pf, logger):
+                    if control is None:
+                        control = start_control(pf, logger)
+                    # skip the run while another process has the profile
+                    if control is not None:
+                        process(pf, logger)
+                if cfg.interval is None or pf.draining:
+                    break
+                wakeup.wait(cfg.interval)
+                wakeup.clear()
+                if reload_requested.is_set() or cfg.has_changed():
+                    reload_requested.clear()
+                    (cfg, pf) = reload_profile(cfg, pf, logger)
+                    if control is not None:
+                        control.profile = pf
+        finally:
+            if control is not None:
+                control.stop()
+            if lease is not None:
+                lease.release()
 
     # fatal errors
     except (Config.ConfigError,
@@ -71,8 +267,13 @@ def main():
             Profile.ProfileKeyError,
             Profile.ProfileLoadError,
             Profile.ProfileCheckError,
-            Profile.ProfileProcessingError) as e:
+            Profile.ProfileProcessingError,
+            Cluster.ClusterError,
+            Admission.AdmissionError) as e:
         logger.error(e)
         sys.exit(1)
+    except socket.error as e:
+        logger.error("control socket error (%s)", e)
+        sys.exit(1)
 
 main()
@@ -0,0 +1,119 @@
+"""Admission controller class."""
+import errno
+import fcntl
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+
+class AdmissionError(Exception):
+
+    """Admission exception."""
+
+    pass
+
+
+class AdmissionController(object):
+
+    """
+    Limit the drush operations running at once on the host.
+
+    All the profiles share 'max_operations' slots: each slot is a file
+    locked with flock() in '<runtime_dir>/admission' (host-local), so a
+    slot is freed even if the process crashes.
+    An operation is also delayed while the load average or the output of
+    the probe command is above its threshold.
+    The slot is held per thread: concurrent operations of a profile
+    (several targets) each take a slot.
+    """
+
+    def __init__(self, runtime_dir, logger, max_operations=0, max_load=None,
+                 probe_command=None, probe_threshold=None, poll_interval=5):
+        """Constructor."""
+        self.slots_dir = os.path.join(runtime_dir, "admission")
+        self.logger = logger
+        self.max_operations = max_operations
+        self.max_load = max_load
+        self.probe_command = probe_command
+        self.probe_threshold = probe_threshold
+        self.poll_interval = poll_interval
+        self.local = threading.local()
+        if max_operations > 0 and not os.path.isdir(self.slots_dir):
+            os.makedirs(self.slots_dir)
+
+    def acquire(self):
+        """
+        Wait until the operation can run.
+
+        Return the waiting time in seconds.
+        """
+        start_time = time.time()
+        waiting = None
+        while True:
+            reason = self._busy()
+            if reason is None:
+                if self._acquire_slot():
+                    break
+                reason = "%s operations already running" % self.max_operations
+            if reason != waiting:
+                self.logger.info("operation delayed: %s", reason)
+                waiting = reason
+            time.sleep(self.poll_interval)
+
+        return time.time() - start_time
+
+    def release(self):
+        """Free the slot of the operation."""
+        slot = getattr(self.local, "slot", None)
+        if slot is not None:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+            self.local.slot = None
+
+    def _acquire_slot(self):
+        """Lock a free slot file, return False if they are all used."""
+        if self.max_operations <= 0:
+            return True
+        for i in range(self.max_operations):
+            slot = open(os.path.join(self.slots_dir, "slot-%s.lock" % i), "a")
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                slot.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    continue
+                raise AdmissionError("can't lock slot '%s' (%s)" %
+                                     (slot.name, e))
+            self.local.slot = slot
+            return True
+
+        return False
+
+    def _busy(self):
+        """Return the reason why the host is busy, None if it isn't."""
+        if self.max_load is not None:
+            load = os.getloadavg()[0]
+            if load > self.max_load:
+                return "load average %.2f > %s" % (load, self.max_load)
+
+        if self.probe_command is not None:
+            value = self._probe()
+            if value is not None and value > self.probe_threshold:
+                return "probe value %s > %s" % (value, self.probe_threshold)
+
+        return None
+
+    def _probe(self):
+        """Run the probe command and return its output as a number."""
+        try:
+            probe_cmd = subprocess.Popen(shlex.split(self.probe_command),
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+            (probe_out, probe_err) = probe_cmd.communicate()
+            return float(probe_out.strip())
+        except (OSError, ValueError) as e:
+            self.logger.warning("probe command '%s' failed (%s)",
+                                self.probe_command, e)
+            return None
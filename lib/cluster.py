@@ -0,0 +1,206 @@
+"""Cluster lease class."""
+import errno
+import json
+import os
+import socket
+import threading
+import time
+
+
+class ClusterError(Exception):
+
+    """Cluster exception."""
+
+    pass
+
+
+class Lease(object):
+
+    """
+    Claim of a profile by one importer node.
+
+    Several hosts share the 'directory' (NFS): a profile is processed by
+    the node holding its '<alias>.lease' file, so the jobs order of the
+    profile is preserved.
+    - the lease is created with link(), which is atomic on NFS
+    - the owner renews the lease expiry in a heartbeat thread
+    - an expired lease (crashed node) is taken over by another node, one
+      ttl after its expiry
+    Hosts clocks must be synchronized.
+    """
+
+    def __init__(self, directory, alias, ttl=60, max_profiles=0):
+        """Constructor."""
+        self.directory = directory
+        self.alias = alias
+        self.ttl = ttl
+        self.max_profiles = max_profiles
+        self.node = socket.gethostname()
+        self.pid = os.getpid()
+        self.lease_file = os.path.join(directory, alias + ".lease")
+        self.held = False
+        self.took_over = False
+        self.owner = None
+        self.heartbeat = None
+        self.stop_heartbeat = threading.Event()
+        if not os.path.isdir(directory):
+            raise ClusterError("cluster directory '%s' doesn't exists" %
+                               directory)
+
+    def acquire(self):
+        """
+        Try to claim the profile.
+
+        Return True if the lease is held by the current process.
+        """
+        if self.held:
+            return True
+
+        lease = self._read(self.lease_file)
+        if lease is not None:
+            # a node that lost its lease may still run its last operation:
+            # the lease (and the profile locks) are taken over once it is
+            # expired for more than a ttl
+            if lease["expires"] + self.ttl > time.time():
+                self.owner = "%s/%s" % (lease["node"], lease["pid"])
+                return False
+            if not self._remove_expired(lease):
+                return False
+
+        # spread the profiles across the nodes
+        if self.max_profiles > 0 and self.node_leases() >= self.max_profiles:
+            self.owner = None
+            return False
+
+        if not self._create():
+            return False
+
+        self.took_over = lease is not None
+        self.held = True
+        self.owner = "%s/%s" % (self.node, self.pid)
+        self.stop_heartbeat.clear()
+        self.heartbeat = threading.Thread(target=self._heartbeat)
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+
+        return True
+
+    def release(self):
+        """Stop the heartbeat and remove the lease if still held."""
+        if self.heartbeat is not None:
+            self.stop_heartbeat.set()
+            self.heartbeat.join()
+            self.heartbeat = None
+        if self.held and self._is_owner():
+            os.remove(self.lease_file)
+        self.held = False
+
+    def node_leases(self):
+        """Return the number of valid leases held by the current node."""
+        count = 0
+        for f in os.listdir(self.directory):
+            if not f.endswith(".lease"):
+                continue
+            lease = self._read(os.path.join(self.directory, f))
+            if (lease is not None and lease["node"] == self.node
+                    and lease["expires"] > time.time()):
+                count += 1
+
+        return count
+
+    def _data(self):
+        """Return the lease content of the current process."""
+        return {"node": self.node,
+                "pid": self.pid,
+                "alias": self.alias,
+                "expires": time.time() + self.ttl}
+
+    def _read(self, lease_file):
+        """Return the content of 'lease_file' or None if absent."""
+        try:
+            with open(lease_file, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_tmp(self):
+        """Write the lease content in a temporary file and return it."""
+        tmp_file = os.path.join(self.directory, ".%s.%s.%s.tmp" %
+                                (self.alias, self.node, self.pid))
+        with open(tmp_file, "w") as f:
+            json.dump(self._data(), f)
+
+        return tmp_file
+
+    def _create(self):
+        """
+        Create the lease file.
+
+        link() may report an error on NFS even if it succeeded, so the
+        links count of the temporary file is checked.
+        """
+        tmp_file = self._write_tmp()
+        try:
+            try:
+                os.link(tmp_file, self.lease_file)
+            except OSError:
+                pass
+            return os.stat(tmp_file).st_nlink == 2
+        finally:
+            os.remove(tmp_file)
+
+    def _remove_expired(self, lease):
+        """
+        Remove the expired 'lease'.
+
+        The lease is first renamed to a file unique to the current process:
+        only one node can win the rename.
+        Return False if another node took over the lease first.
+        """
+        stale_file = "%s.%s.%s.stale" % (self.lease_file, self.node, self.pid)
+        try:
+            os.rename(self.lease_file, stale_file)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return True
+            raise
+
+        if self._read(stale_file) != lease:
+            # a new lease was renamed: give it back
+            try:
+                os.link(stale_file, self.lease_file)
+            except OSError:
+                pass
+            os.remove(stale_file)
+            return False
+
+        os.remove(stale_file)
+        return True
+
+    def _is_owner(self):
+        """Return True if the lease file belongs to the current process."""
+        lease = self._read(self.lease_file)
+
+        return (lease is not None and lease["node"] == self.node
+                and lease["pid"] == self.pid)
+
+    def _heartbeat(self):
+        """
+        Renew the lease expiry until released or lost.
+
+        Another node may take over an expired lease at any time: the lease
+        is only renewed while it is still valid for a while. Any error
+        loses the lease.
+        """
+        while not self.stop_heartbeat.wait(self.ttl / 3.0):
+            try:
+                lease = self._read(self.lease_file)
+                if (lease is None or lease["node"] != self.node
+                        or lease["pid"] != self.pid
+                        or lease["expires"] - time.time() < self.ttl / 6.0):
+                    self.held = False
+                    return
+                os.rename(self._write_tmp(), self.lease_file)
+            except Exception:
+                self.held = False
+                return
@@ -1,5 +1,6 @@
 """Configuration class."""
 import argparse
+import os
 import yaml
 
 
@@ -17,6 +18,134 @@ class ConfigParserError(Exception):
     pass
 
 
+# required keys and their types
+# - nested keys use the dot notation
+CONFIG_SCHEMA = {
+    "state_dir": basestring,
+    "log.directory": basestring,
+    "drupal.root": basestring,
+    "drupal.uri": basestring,
+    "profiles": list,
+}
+
+PROFILE_SCHEMA = {
+    "id": int,
+    "alias": basestring,
+    "source.directory": basestring,
+    "source.objects": basestring,
+    "source.config": basestring,
+    "source.parameter.name": basestring,
+    "source.parameter.class": basestring,
+    "target.directory": basestring,
+    "target.objects": basestring,
+    "target.config": basestring,
+    "operations": list,
+}
+
+# optional keys and their types
+CONFIG_OPTIONAL_SCHEMA = {
+    "runtime_dir": basestring,
+    "log.structured": bool,
+    "log.level": basestring,
+    "cluster.directory": basestring,
+    "cluster.lease_ttl": int,
+    "cluster.max_profiles": int,
+    "admission.max_operations": int,
+    "admission.max_load": (int, float),
+    "admission.probe.command": basestring,
+    "admission.probe.threshold": (int, float),
+    "admission.poll_interval": (int, float),
+}
+
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+PROFILE_OPTIONAL_SCHEMA = {
+    "todo_queue_limit": int,
+    "snapshot": bool,
+    "lookahead.depth": int,
+    "lookahead.workers": int,
+    "lookahead.min_size": int,
+    "lookahead.max_size": int,
+    "output_parser": dict,
+    "staging.directory": basestring,
+    "staging.max_size": int,
+    "staging.depth": int,
+    "staging.workers": int,
+    "targets": list,
+    "delta.id_attribute": basestring,
+    "delta.max_ratio": (int, float),
+    "timing.bootstrap_end": basestring,
+    "timing.command_end": basestring,
+    "timing.keep_raw": bool,
+}
+
+TARGET_SCHEMA = {
+    "name": basestring,
+    "root": basestring,
+    "uri": basestring,
+}
+
+ALERT_SCHEMA = {
+    "handler": basestring,
+}
+
+ALERT_HANDLER_SCHEMA = {
+    "mail": {
+        "config.smtp_host": basestring,
+        "config.smtp_port": int,
+        "config.smtp_user": basestring,
+        "config.smtp_password": basestring,
+        "config.sender": basestring,
+        "config.recipients": list,
+        "config.subject": basestring,
+        "config.message": basestring,
+    },
+}
+
+
+def lookup(data, key):
+    """
+    Return the value of the dotted 'key' into 'data'.
+
+    Raise a KeyError when one of the levels is missing.
+    """
+    value = data
+    for k in key.split("."):
+        if not isinstance(value, dict):
+            raise KeyError(key)
+        value = value[k]
+
+    return value
+
+
+def lookup_default(data, key, default=None):
+    """Return the value of the dotted 'key' or 'default' if missing."""
+    try:
+        return lookup(data, key)
+    except KeyError:
+        return default
+
+
+def check_schema(data, schema, prefix, errors, required=True):
+    """
+    Append to 'errors' the keys of 'data' that don't match 'schema'.
+
+    Optional keys ('required' is False) may be empty.
+    """
+    for key in sorted(schema):
+        try:
+            value = lookup(data, key)
+        except KeyError:
+            if required:
+                errors.append("%s%s: missing" % (prefix, key))
+            continue
+        if value is None and not required:
+            continue
+        if not isinstance(value, schema[key]):
+            errors.append("%s%s: bad type '%s'" %
+                          (prefix, key, type(value).__name__))
+
+
 class Config(object):
 
     """Defined a configuration."""
@@ -25,40 +154,180 @@ class Config(object):
         """Constructor."""
         self.file = config_file
         self.config = {}
+        self.profiles = {"id": {}, "alias": {}}
+        self.mtime = None
         self.profile = ""
+        self.command = "run"
+        self.control = None
+        self.interval = None
         if config_file is "":
             raise ConfigError("'config_file' is empty")
 
     def load(self):
-        """Load application configuration file."""
+        """
+        Load application configuration file.
+
+        The configuration is validated and the profiles are indexed:
+        an invalid file raises a ConfigError listing all the errors.
+        """
         try:
+            mtime = os.path.getmtime(self.file)
             with open(self.file, 'r') as ymlfile:
-                self.config = yaml.load(ymlfile)
-        except IOError:
+                config = yaml.load(ymlfile)
+        except (IOError, OSError):
             raise ConfigError("configuration file '%s' not found" %
                               self.file)
 
+        profiles = self.validate(config)
+        self.config = config
+        self.profiles = profiles
+        self.mtime = mtime
+
+    def reload(self):
+        """
+        Reload the configuration file.
+
+        The current configuration is kept if the new one is invalid or
+        doesn't contain the selected profile anymore.
+        """
+        config = self.config
+        profiles = self.profiles
+        mtime = self.mtime
+        self.load()
+        if self.get_profile(self.profile) is None:
+            self.config = config
+            self.profiles = profiles
+            self.mtime = mtime
+            raise ConfigError("profile '%s' not found in new configuration" %
+                              self.profile)
+
+    def has_changed(self):
+        """Return True if the configuration file was modified since load."""
+        try:
+            return os.path.getmtime(self.file) != self.mtime
+        except OSError:
+            return False
+
+    def validate(self, config):
+        """
+        Check the configuration against the schema.
+
+        Return the profiles indexed by 'id' and by 'alias'.
+        """
+        errors = []
+        if not isinstance(config, dict):
+            raise ConfigError("configuration file '%s' is empty or invalid" %
+                              self.file)
+
+        check_schema(config, CONFIG_SCHEMA, "", errors)
+        check_schema(config, CONFIG_OPTIONAL_SCHEMA, "", errors,
+                     required=False)
+        if (lookup_default(config, "admission.probe.command") is not None
+                and lookup_default(config, "admission.probe.threshold") is None):
+            errors.append("admission.probe.threshold: missing")
+        # the state directory is shared by the nodes: the host-local files
+        # (control socket, admission slots) need their own directory
+        if (lookup_default(config, "cluster.directory") is not None
+                and lookup_default(config, "runtime_dir") in
+                [None, lookup_default(config, "state_dir")]):
+            errors.append("runtime_dir: a host-local directory is required "
+                          "with cluster.directory")
+        level = lookup_default(config, "log.level")
+        if (isinstance(level, basestring)
+                and level.upper() not in LOG_LEVELS):
+            errors.append("log.level: unknown level '%s'" % level)
+
+        profiles = {"id": {}, "alias": {}}
+        for i, profile in enumerate(config.get("profiles") or []):
+            prefix = "profiles[%s]." % i
+            if not isinstance(profile, dict):
+                errors.append("%s: not a mapping" % prefix[:-1])
+                continue
+            check_schema(profile, PROFILE_SCHEMA, prefix, errors)
+            check_schema(profile, PROFILE_OPTIONAL_SCHEMA, prefix, errors,
+                         required=False)
+            if (profile.get("staging") is not None
+                    and lookup_default(profile, "staging.directory") is None):
+                errors.append("%sstaging.directory: missing" % prefix)
+            for access_by in ["id", "alias"]:
+                key = profile.get(access_by)
+                if key is None:
+                    continue
+                if key in profiles[access_by]:
+                    errors.append("%s%s: duplicate value '%s'" %
+                                  (prefix, access_by, key))
+                profiles[access_by][key] = profile
+            names = set()
+            for j, target in enumerate(profile.get("targets") or []):
+                target_prefix = "%stargets[%s]." % (prefix, j)
+                if not isinstance(target, dict):
+                    errors.append("%s: not a mapping" % target_prefix[:-1])
+                    continue
+                check_schema(target, TARGET_SCHEMA, target_prefix, errors)
+                if target.get("name") in names:
+                    errors.append("%sname: duplicate value '%s'" %
+                                  (target_prefix, target.get("name")))
+                names.add(target.get("name"))
+
+        for i, alerter in enumerate(config.get("alert") or []):
+            prefix = "alert[%s]." % i
+            if not isinstance(alerter, dict):
+                errors.append("%s: not a mapping" % prefix[:-1])
+                continue
+            check_schema(alerter, ALERT_SCHEMA, prefix, errors)
+            handler_schema = ALERT_HANDLER_SCHEMA.get(alerter.get("handler"))
+            if handler_schema is not None:
+                check_schema(alerter, handler_schema, prefix, errors)
+
+        if len(errors) > 0:
+            raise ConfigError("invalid configuration file '%s' (%s)" %
+                              (self.file, ", ".join(errors)))
+
+        return profiles
+
     def parse_args(self):
         """Parser configuration."""
         parser = argparse.ArgumentParser()
+        parser.add_argument("command", nargs="?", default="run",
+                            choices=["run", "report"],
+                            help="import the new files (default) or print "
+                                 "the run history report")
         parser.add_argument("--profile", "-p", help="profile")
+        parser.add_argument("--control", "-c",
+                            choices=["status", "pause", "resume", "drain"],
+                            help="send a command to the running profile")
+        parser.add_argument("--interval", "-i", type=int,
+                            help="keep running and check the source "
+                                 "directory every 'interval' seconds")
         parser.add_argument('--version', action='version',
                             version='1.0.1')
 
-        if parser.parse_args().profile is None:
+        self.command = parser.parse_args().command
+        # the report covers all the profiles by default
+        if parser.parse_args().profile is None and self.command != "report":
             raise ConfigParserError("no profile specified")
         else:
             self.profile = parser.parse_args().profile
+            self.control = parser.parse_args().control
+            self.interval = parser.parse_args().interval
 
     def get_value(self, key):
         """Get the value of the specified key."""
-        key_tab = key.split(".")
         try:
-            if len(key_tab) == 1:
-                value = self.config[key_tab[0]]
-            elif len(key_tab) == 2:
-                value = self.config[key_tab[0]][key_tab[1]]
+            value = lookup(self.config, key)
         except KeyError:
-                value = None
+            value = None
 
         return value
+
+    def get_profile(self, profile_key):
+        """
+        Return the profile accessed by his 'id' or his 'alias'.
+
+        A numeric key is an 'id', others are 'alias'.
+        Return None if the profile doesn't exist.
+        """
+        if str(profile_key).isdigit():
+            return self.profiles["id"].get(int(profile_key))
+        else:
+            return self.profiles["alias"].get(profile_key)
@@ -0,0 +1,113 @@
+"""Control socket class."""
+import errno
+import json
+import os
+import socket
+import SocketServer
+import threading
+
+
+class ControlError(Exception):
+
+    """Control socket exception."""
+
+    pass
+
+
+class ControlRequestHandler(SocketServer.StreamRequestHandler):
+
+    """Handle one command sent on the control socket."""
+
+    def handle(self):
+        """Read a command line and write back a json response."""
+        command = self.rfile.readline().strip()
+        response = self.server.dispatch(command)
+        self.wfile.write(json.dumps(response) + "\n")
+
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    """
+    Unix domain socket exposing the state of a running profile.
+
+    Commands are single lines, responses are json objects:
+    - 'status': current active job, queues, backlog and throughput
+    - 'pause': don't start the next job until 'resume'
+    - 'resume': restart the jobs processing
+    - 'drain': finish the current job and stop processing
+    """
+
+    daemon_threads = True
+    commands = ["status", "pause", "resume", "drain"]
+
+    def __init__(self, socket_file, profile):
+        """Constructor."""
+        self.socket_file = socket_file
+        self.profile = profile
+        self.thread = None
+        self.inode = None
+        if os.path.exists(socket_file):
+            # a socket answering means another process is running,
+            # a refused connection a socket left by a crashed process
+            try:
+                send_command(socket_file, "status")
+                raise ControlError("control socket '%s' is already in use" %
+                                   socket_file)
+            except socket.error as e:
+                if e.errno != errno.ECONNREFUSED:
+                    raise ControlError("control socket '%s' is in use (%s)" %
+                                       (socket_file, e))
+                os.remove(socket_file)
+
+        SocketServer.UnixStreamServer.__init__(self, socket_file,
+                                               ControlRequestHandler)
+        # the socket file is only removed by the server which created it
+        self.inode = os.stat(socket_file).st_ino
+
+    def start(self):
+        """Serve the requests in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving and remove the socket file."""
+        if self.thread is not None:
+            self.shutdown()
+            self.thread = None
+        self.server_close()
+        try:
+            if os.stat(self.socket_file).st_ino == self.inode:
+                os.remove(self.socket_file)
+        except OSError:
+            pass
+
+    def dispatch(self, command):
+        """Run the given command and return the response."""
+        if command not in self.commands:
+            return {"result": "error",
+                    "message": "unknown command '%s'" % command}
+
+        if command != "status":
+            getattr(self.profile, command)()
+
+        return {"result": "ok", "status": self.profile.status()}
+
+
+def send_command(socket_file, command, timeout=5):
+    """Send a command to the control socket and return the response."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_file)
+        client.sendall(command + "\n")
+        response = ""
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            response += data
+    finally:
+        client.close()
+
+    return json.loads(response)
@@ -0,0 +1,291 @@
+"""Delta extractor class."""
+import gzip
+import hashlib
+import heapq
+import os
+import tempfile
+import xml.parsers.expat
+from xml.sax.saxutils import escape, quoteattr
+
+
+class DeltaError(Exception):
+
+    """Delta extraction exception."""
+
+    pass
+
+
+def open_source(filename):
+    """Open a source file, '.gz' files are decompressed on the fly."""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+
+    return open(filename, "rb")
+
+
+class DeltaExtractor(object):
+
+    """
+    Extract the objects changed since the last imported snapshot.
+
+    The objects are the children of the root element, keyed on their
+    'id_attribute'. Instead of the previous XML file, an index of the
+    imported objects sorted by id (id, digest and tag of each object, one
+    per line) is kept.
+    The comparison is memory-bounded:
+    - the new file is parsed (streaming) into an index, sorted on disk in
+      chunks of 'sort_size' lines
+    - both sorted indexes are merged to find the changes
+    - the new file is parsed again to copy the changed objects
+    Only one object and one sort chunk are held in memory.
+    The delta file has the same root element with the added and changed
+    objects, then an empty element per removed object, e.g.
+      <object id="42" delta="removed"/>
+    Only the elements, attributes and text of the objects are kept: the
+    comments, processing instructions, DOCTYPE and root-level text are
+    dropped from the delta.
+    """
+
+    chunk_size = 65536
+    sort_size = 100000
+
+    def __init__(self, id_attribute="id"):
+        """Constructor."""
+        self.id_attribute = id_attribute
+
+    def extract(self, objects_file, index_file, new_index_file, delta_file):
+        """
+        Write the index of 'objects_file' and its delta.
+
+        The delta is computed against 'index_file', it isn't written when
+        there's no index yet.
+        Return the number of added, changed and removed objects and the
+        (uncompressed) size of 'objects_file', None without delta.
+        """
+        tmp_dir = os.path.dirname(new_index_file)
+        tmp_files = []
+
+        def tmp_file():
+            (fd, filename) = tempfile.mkstemp(dir=tmp_dir, suffix=".tmp")
+            os.close(fd)
+            tmp_files.append(filename)
+            return filename
+
+        try:
+            # index of the new file: id, digest, tag, object number
+            records = tmp_file()
+            with open(records, "w") as out:
+                reader = _ObjectReader(self.id_attribute)
+                reader.read(objects_file, self.chunk_size,
+                            lambda n, object_id, tag, data: out.write(
+                                "%s\t%s\t%s\t%012d\n" %
+                                (object_id, hashlib.md5(data).hexdigest(),
+                                 tag, n)))
+            sorted_records = tmp_file()
+            self._sort(records, sorted_records, tmp_file)
+
+            if not os.path.isfile(index_file):
+                with open(sorted_records, "r") as f:
+                    with open(new_index_file, "w") as out:
+                        for line in f:
+                            out.write(line.rsplit("\t", 1)[0] + "\n")
+                return None
+
+            # changed objects numbers and removed objects
+            wanted = tmp_file()
+            removed = tmp_file()
+            delta = self._merge(index_file, sorted_records, new_index_file,
+                                wanted, removed)
+            sorted_wanted = tmp_file()
+            self._sort(wanted, sorted_wanted, tmp_file)
+            self._write_delta(objects_file, sorted_wanted, removed,
+                              delta_file)
+            delta["size"] = reader.size
+
+            return delta
+        except xml.parsers.expat.ExpatError as e:
+            raise DeltaError("'%s' isn't well formed XML (%s)" %
+                             (objects_file, e))
+        finally:
+            for filename in tmp_files:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def _sort(self, in_file, out_file, tmp_file):
+        """Sort the lines of 'in_file' into 'out_file' (external sort)."""
+        chunks = []
+        with open(in_file, "r") as f:
+            while True:
+                lines = []
+                for line in f:
+                    lines.append(line)
+                    if len(lines) >= self.sort_size:
+                        break
+                if len(lines) == 0:
+                    break
+                lines.sort()
+                chunk = tmp_file()
+                with open(chunk, "w") as out:
+                    out.writelines(lines)
+                chunks.append(chunk)
+
+        files = [open(chunk, "r") for chunk in chunks]
+        try:
+            with open(out_file, "w") as out:
+                out.writelines(heapq.merge(*files))
+        finally:
+            for f in files:
+                f.close()
+                os.remove(f.name)
+
+    def _merge(self, index_file, records_file, new_index_file, wanted_file,
+               removed_file):
+        """
+        Compare the sorted indexes.
+
+        Write the new index, the numbers of the added and changed objects
+        and the removed objects. Return the number of each change.
+        """
+        delta = {"added": 0, "changed": 0, "removed": 0}
+        index = open(index_file, "r")
+        records = open(records_file, "r")
+        new_index = open(new_index_file, "w")
+        wanted = open(wanted_file, "w")
+        removed = open(removed_file, "w")
+        try:
+            old = self._next(index)
+            new = self._next(records)
+            while old is not None or new is not None:
+                if new is None or (old is not None and old[0] < new[0]):
+                    removed.write("%s\t%s\n" % (old[2], old[0]))
+                    delta["removed"] += 1
+                    old = self._next(index)
+                    continue
+                new_index.write("\t".join(new[:3]) + "\n")
+                if old is not None and old[0] == new[0]:
+                    if old[1] != new[1]:
+                        wanted.write(new[3] + "\n")
+                        delta["changed"] += 1
+                    old = self._next(index)
+                else:
+                    wanted.write(new[3] + "\n")
+                    delta["added"] += 1
+                new = self._next(records)
+        finally:
+            for f in [index, records, new_index, wanted, removed]:
+                f.close()
+
+        return delta
+
+    def _next(self, f):
+        """Return the fields of the next index line, None at the end."""
+        line = f.readline()
+        if not line:
+            return None
+
+        return line.rstrip("\n").split("\t")
+
+    def _write_delta(self, objects_file, wanted_file, removed_file,
+                     delta_file):
+        """Copy the wanted objects of 'objects_file' into the delta."""
+        with open(delta_file, "w") as out:
+            with open(wanted_file, "r") as wanted:
+                state = {"next": wanted.readline()}
+
+                def copy(n, object_id, tag, data):
+                    if state["next"] and int(state["next"]) == n:
+                        out.write(data + "\n")
+                        state["next"] = wanted.readline()
+
+                reader = _ObjectReader(self.id_attribute, out)
+                reader.read(objects_file, self.chunk_size, copy)
+            # objects absent from the new file
+            with open(removed_file, "r") as removed:
+                for line in removed:
+                    (tag, object_id) = line.rstrip("\n").split("\t", 1)
+                    out.write('<%s %s=%s delta="removed"/>\n' %
+                              (tag, self.id_attribute, quoteattr(object_id)))
+            out.write("</%s>\n" % reader.root)
+
+
+class _ObjectReader(object):
+
+    """
+    Streaming reader of the objects (expat handlers).
+
+    Each object is serialized (sorted attributes) and passed to a callback
+    with its number, id and tag. The root start tag is written to 'out'.
+    """
+
+    def __init__(self, id_attribute, out=None):
+        """Constructor."""
+        self.id_attribute = id_attribute
+        self.out = out
+        self.callback = None
+        self.depth = 0
+        self.root = None
+        self.parts = []
+        self.count = 0
+        self.object_id = None
+        self.object_tag = None
+        self.size = 0
+
+    def read(self, objects_file, chunk_size, callback):
+        """Parse 'objects_file', call 'callback' for each object."""
+        self.callback = callback
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.character_data
+        with open_source(objects_file) as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                self.size += len(data)
+                parser.Parse(data, False)
+        parser.Parse("", True)
+
+    def start_element(self, name, attrs):
+        """Start a root, object or object child element."""
+        self.depth += 1
+        name = name.encode("utf-8")
+        tag = "<" + name + "".join(
+            " %s=%s" % (k.encode("utf-8"), quoteattr(v.encode("utf-8")))
+            for k, v in sorted(attrs.items())) + ">"
+        if self.depth == 1:
+            self.root = name
+            if self.out is not None:
+                self.out.write('<?xml version="1.0" '
+                               'encoding="UTF-8"?>\n%s\n' % tag)
+            return
+        if self.depth == 2:
+            try:
+                self.object_id = attrs[self.id_attribute].encode("utf-8")
+            except KeyError:
+                raise DeltaError("object <%s> has no '%s' attribute" %
+                                 (name, self.id_attribute))
+            if "\t" in self.object_id or "\n" in self.object_id:
+                raise DeltaError("object id %s isn't supported" %
+                                 quoteattr(self.object_id))
+            self.object_tag = name
+            self.parts = []
+        self.parts.append(tag)
+
+    def end_element(self, name):
+        """End an element, a complete object is passed to the callback."""
+        self.depth -= 1
+        if self.depth < 1:
+            return
+        self.parts.append("</%s>" % name.encode("utf-8"))
+        if self.depth > 1:
+            return
+        data = "".join(self.parts)
+        self.parts = []
+        self.callback(self.count, self.object_id, self.object_tag, data)
+        self.count += 1
+
+    def character_data(self, data):
+        """Add the text of an object."""
+        if self.depth > 1:
+            self.parts.append(escape(data.encode("utf-8")))
@@ -1,5 +1,11 @@
 """Logging class."""
+import atexit
+import datetime
+import json
 import logging
+import os
+import Queue
+import threading
 
 from colorlog import ColoredFormatter
 
@@ -23,3 +29,259 @@ def configure():
     logger.addHandler(stream_handler)
 
     return logger
+
+
+def configure_structured(logger, profile, log_dir, level="DEBUG"):
+    """
+    Switch the logger to the structured (json) and non-blocking mode.
+
+    Records are put into a queue by the processing thread, a listener
+    thread writes them to the console and to the per-job log files.
+    """
+    logger.setLevel(getattr(logging, level.upper()))
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+    job_handler = JobFileHandler(log_dir)
+    job_handler.setFormatter(JsonFormatter())
+
+    listener = QueueListener(Queue.Queue(), stream_handler, job_handler)
+    queue_handler = QueueHandler(listener)
+    logger.addHandler(queue_handler)
+    logger.addFilter(ContextFilter(profile))
+    listener.start()
+    atexit.register(listener.stop)
+
+    return logger
+
+
+def set_profile(logger, profile):
+    """Set the profile of the context fields (profile reloaded)."""
+    for f in logger.filters:
+        if isinstance(f, ContextFilter):
+            f.profile = profile
+
+
+def reopen(logger, job_id):
+    """
+    Accept the records of 'job_id' again.
+
+    Called when a job becomes active: a retried job is logged again.
+    """
+    for handler in logger.handlers:
+        listener = getattr(handler, "listener", None)
+        if listener is None:
+            continue
+        for h in listener.handlers:
+            if isinstance(h, JobFileHandler):
+                h.open_job(job_id)
+
+
+def flush(logger, job_id):
+    """
+    Wait for the queued records and close the log file of 'job_id'.
+
+    Called before archiving the job log directory.
+    """
+    for handler in logger.handlers:
+        listener = getattr(handler, "listener", None)
+        if listener is None:
+            continue
+        listener.sync()
+        for h in listener.handlers:
+            if isinstance(h, JobFileHandler):
+                h.close_job(job_id)
+
+
+class ContextFilter(logging.Filter):
+
+    """Add the profile, job id and operation to the records."""
+
+    def __init__(self, profile):
+        """Constructor."""
+        logging.Filter.__init__(self)
+        self.profile = profile
+
+    def filter(self, record):
+        """Set the context fields from the current profile state."""
+        record.profile = self.profile.alias
+        active_queue = list(self.profile.active_queue)
+        record.job_id = active_queue[0]["id"] if active_queue else None
+        record.operation = self.profile.active_operation
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+
+    """Format the records as json objects."""
+
+    fields = ["profile", "job_id", "operation"]
+
+    def format(self, record):
+        """Return the json representation of the record."""
+        data = {"time": datetime.datetime.fromtimestamp(
+                    record.created).strftime("%Y-%m-%dT%H:%M:%S.%f"),
+                "level": record.levelname,
+                "message": record.getMessage()}
+        for field in self.fields:
+            data[field] = getattr(record, field, None)
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exception"] = record.exc_text
+
+        return json.dumps(data)
+
+
+class QueueHandler(logging.Handler):
+
+    """Put the records into the listener queue (python < 3.2)."""
+
+    def __init__(self, listener):
+        """Constructor."""
+        logging.Handler.__init__(self)
+        self.listener = listener
+
+    def prepare(self, record):
+        """Merge the message arguments: they may not be thread-safe."""
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def emit(self, record):
+        """Enqueue the record."""
+        try:
+            self.listener.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+
+    """Dequeue the records and pass them to the handlers (python < 3.2)."""
+
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        """Constructor."""
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        """Start the listener thread."""
+        self.thread = threading.Thread(target=self._monitor)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Write the remaining records and stop the listener thread."""
+        if self.thread is not None:
+            self.queue.put(self._sentinel)
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers:
+            handler.close()
+
+    def sync(self):
+        """Block until all the records queued before the call are written."""
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def _monitor(self):
+        """Listener thread loop."""
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            # sync() marker
+            if not isinstance(record, logging.LogRecord):
+                record.set()
+                continue
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+class JobFileHandler(logging.Handler):
+
+    """
+    Write the records of a job into its log directory.
+
+    The file '<log_dir>/<profile>/<job_id>/job.log' is written beside the
+    operations logs, only while the job log directory exists: it is
+    created when the job becomes active.
+    """
+
+    filename = "job.log"
+
+    def __init__(self, log_dir):
+        """Constructor."""
+        logging.Handler.__init__(self)
+        self.log_dir = log_dir
+        self.job_id = None
+        self.stream = None
+        self.closed_jobs = set()
+
+    def emit(self, record):
+        """Write the record into the file of its job."""
+        job_id = getattr(record, "job_id", None)
+        if job_id is None or job_id in self.closed_jobs:
+            return
+        try:
+            if job_id != self.job_id:
+                self._close_stream()
+                job_logdir = os.path.join(self.log_dir, record.profile, job_id)
+                if not os.path.isdir(job_logdir):
+                    return
+                self.stream = open(os.path.join(job_logdir, self.filename),
+                                   "a")
+                self.job_id = job_id
+            self.stream.write(self.format(record) + "\n")
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def open_job(self, job_id):
+        """Accept the records of 'job_id' again."""
+        self.acquire()
+        try:
+            self.closed_jobs.discard(job_id)
+        finally:
+            self.release()
+
+    def close_job(self, job_id):
+        """Close the file of 'job_id' and ignore its next records."""
+        self.acquire()
+        try:
+            self.closed_jobs.add(job_id)
+            if self.job_id == job_id:
+                self._close_stream()
+        finally:
+            self.release()
+
+    def close(self):
+        """Close the current file."""
+        self.acquire()
+        try:
+            self._close_stream()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+    def _close_stream(self):
+        """Close the current stream."""
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = None
+        self.job_id = None
@@ -0,0 +1,138 @@
+"""Output parser class."""
+import re
+
+
+class OutputParserError(Exception):
+
+    """Output parser configuration exception."""
+
+    pass
+
+
+def compile_rules(config):
+    """
+    Compile the parser rules of each operation.
+
+    'config' maps an operation (or 'default') to its rules: a metric name
+    and a regex whose first group is the count, e.g.
+      import:
+        created: "Created: ([0-9]+)"
+    """
+    rules = {}
+    for operation, operation_rules in config.items():
+        if not isinstance(operation_rules, dict):
+            raise OutputParserError("rules of '%s' aren't a mapping" %
+                                    operation)
+        rules[operation] = []
+        for metric, pattern in sorted(operation_rules.items()):
+            try:
+                regex = re.compile(pattern)
+            except (re.error, TypeError) as e:
+                raise OutputParserError("bad rule '%s.%s' (%s)" %
+                                        (operation, metric, e))
+            if regex.groups < 1:
+                raise OutputParserError("rule '%s.%s' has no group" %
+                                        (operation, metric))
+            rules[operation].append((metric, regex))
+
+    return rules
+
+
+class OutputParser(object):
+
+    """Extract counts from the maps-import output, line by line."""
+
+    def __init__(self, rules):
+        """Constructor."""
+        self.rules = rules
+        self.counts = dict((metric, 0) for metric, regex in rules)
+
+    def feed(self, line):
+        """Add the counts found in the output line."""
+        for metric, regex in self.rules:
+            for match in regex.finditer(line):
+                try:
+                    self.counts[metric] += int(match.group(1))
+                except (TypeError, ValueError):
+                    pass
+
+    def metrics(self, duration):
+        """Return the counts and the throughputs (objects per second)."""
+        total = sum(self.counts.values())
+        metrics = {"counts": self.counts,
+                   "objects": total,
+                   "objects_per_second": None,
+                   "throughput": {}}
+        if duration > 0:
+            metrics["objects_per_second"] = total / duration
+            for metric, count in self.counts.items():
+                metrics["throughput"][metric] = count / duration
+
+        return metrics
+
+
+class TimingParser(object):
+
+    """
+    Split an operation time into drush phases.
+
+    drush is run with '--debug': its log lines are stamped with the time
+    since drush started, e.g.
+      Found command: maps-import [0.52 sec, 24.1 MB] [bootstrap]
+    - bootstrap: until the first 'bootstrap_end' line
+    - command: until the first 'command_end' line
+    - shutdown: the rest of the wall clock time (also includes the php
+      start before the drush timer)
+    """
+
+    stamp = re.compile(r"\[([0-9.]+) sec, [^\]]*\]")
+    log_type = re.compile(r"^\s*\[(\w+)\]|\[(\w+)\]\s*$")
+    # debug lines of these types are kept with the drush errors
+    error_types = ["error", "warning", "failed"]
+
+    def __init__(self, bootstrap_end, command_end):
+        """Constructor, the markers are compiled regexes."""
+        self.bootstrap_end = bootstrap_end
+        self.command_end = command_end
+        self.times = {}
+
+    def split(self, stderr):
+        """
+        Read the debug lines of the drush stderr.
+
+        Return the debug lines and the other lines.
+        """
+        debug = []
+        other = []
+        for line in stderr.splitlines(True):
+            match = self.stamp.search(line)
+            if match is None or self._type(line) in self.error_types:
+                other.append(line)
+                continue
+            debug.append(line)
+            for phase, marker in [("bootstrap", self.bootstrap_end),
+                                  ("command", self.command_end)]:
+                if phase not in self.times and marker.search(line):
+                    self.times[phase] = float(match.group(1))
+
+        return "".join(debug), "".join(other)
+
+    def phases(self, duration):
+        """Return the phases durations, None if a marker wasn't found."""
+        try:
+            bootstrap = self.times["bootstrap"]
+            command = self.times["command"]
+        except KeyError:
+            return None
+
+        return {"bootstrap": bootstrap,
+                "command": command - bootstrap,
+                "shutdown": max(duration - command, 0)}
+
+    def _type(self, line):
+        """Return the log type of a drush line."""
+        match = self.log_type.search(line)
+        if match is None:
+            return None
+
+        return match.group(1) or match.group(2)
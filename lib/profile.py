@@ -1,18 +1,32 @@
 """Profile definition."""
+import collections
 import datetime
 import json
+import multiprocessing.pool
 import os
 import tarfile
 import shutil
 import subprocess
 import re
-
+import threading
+
+from lib.delta import DeltaError
+from lib.delta import DeltaExtractor
+from lib.logger import flush as flush_logs
+from lib.logger import reopen as reopen_logs
+from lib.parser import compile_rules
+from lib.parser import OutputParser
+from lib.parser import OutputParserError
+from lib.parser import TimingParser
+from lib.scanner import SourceScanner
+from lib.staging import Stager
 from lib.tools import add_symlink
 from lib.tools import sorted_ls
 from lib.identifier import SourceIdentifierInterface as SourceIdentifierInterface
 from lib.identifier import SourceIdentifierTimestamp as SourceIdentifierTimestamp
 
 from lib.transport import AlertTransportMail as AlertTransportMail
+from lib.validator import SourceValidator
 
 
 class ProfileError(Exception):
@@ -67,15 +81,50 @@ class Profile(object):
         self.alias = ""
         self.config = {}
         self.lock_file = ""
+        self.socket_file = ""
         self.state_file = ""
         self.state_timestamp = "0"
         self.source_object_files = 0
+        self.source_pattern = None
         self.log_dir = log_dir
         # queues
         self.todo_queue = []
         self.todo_queue_limit = 0
         self.active_queue = []
+        self.snapshot = False
+        # look-ahead validation of the next [todo] items
+        self.validator = None
+        self.lookahead_depth = 0
+        self.lookahead_workers = 0
+        self.lookahead_pool = None
+        # maps-import output parser rules, by operation
+        self.output_rules = {}
+        # staging of the next [todo] items on local storage
+        self.stager = None
+        self.staging_depth = 0
+        self.delta_extractor = None
+        self.delta_max_ratio = None
+        self.index_file = None
+        self.scanner = None
+        self.timing_markers = None
+        self.timing_keep_raw = False
+        # processing status (exposed on the control socket)
+        self.backlog_size = 0
+        self.active_operation = None
+        self.target_operations = {}
+        self.job_start_time = None
+        self.operation_start_time = None
+        self.completed_jobs = collections.deque(maxlen=20)
+        self.running = threading.Event()
+        self.running.set()
+        self.draining = False
+        # multi-node mode: claim of the profile (see lib/cluster.py)
+        self.lease = None
         # external "components"
+        self.admission = None
+        # fan out: drupal targets of the profile, see set_targets()
+        self.targets = []
+        self.state_lock = threading.Lock()
         self.logger = logger
         self.drupal = drupal
         self.alerters = []
@@ -84,46 +133,26 @@ class Profile(object):
         """
         Check if the specified profile exists into config.
 
-        The profile can be access by his 'id' or his 'alias'.
-        - We need to detect the type of the profile access and
-        than "cast" it to the right type (integer or string).
+        The profile can be access by his 'id' or his 'alias':
+        profiles are indexed on both keys when the configuration is loaded.
         """
-        # a none numeric argument is supposed to be 'alias'
-        if re.search(r"\b[0-9]+\b", profile_key) is None:
-            key = profile_key
-            self.alias = key
-            access_by = "alias"
-        else:
-            key = (int)(profile_key)
-            self.id = key
-            access_by = "id"
-        self.logger.debug("==> profile will be access by his '%s'" % access_by)
-
-        # check if the profile exists into config...
-        i = 0
-        profile_found = False
-        while (i < len(config["profiles"])
-               and profile_found is False):
-
-            if config["profiles"][i][access_by] == key:
-                profile_found = True
-                self.logger.debug("==> profile '%s' found (access by '%s')" %
-                                  (key, access_by))
-                self.config = config["profiles"][i]
-
-            i += 1
-
-        # ... and if not raise an exception
-        if profile_found is False:
+        self.config = config.get_profile(profile_key)
+        if self.config is None:
             raise ProfileLoadError("profile '%s' not found" % profile_key)
+        self.logger.debug("==> profile '%s' found", profile_key)
 
         # set profile properties
         self.id = self.config["id"]
         self.alias = self.config["alias"]
-        self.state_file = os.path.join(config["state_dir"],
+        state_dir = config.get_value("state_dir")
+        self.state_file = os.path.join(state_dir,
                                        self.config["alias"] + ".json")
-        self.lock_file = os.path.join(config["state_dir"],
+        self.lock_file = os.path.join(state_dir,
                                       self.config["alias"] + ".lock")
+        # host-local runtime files
+        runtime_dir = config.get_value("runtime_dir") or state_dir
+        self.socket_file = os.path.join(runtime_dir,
+                                        self.config["alias"] + ".sock")
 
         # set the todo queue limit based on configuration
         # - default is 1
@@ -133,8 +162,106 @@ class Profile(object):
         except KeyError:
             self.todo_queue_limit = 1
 
+        # in 'snapshot' mode each source file is a full export: only the
+        # newest pending one is imported
+        try:
+            self.snapshot = self.config["snapshot"]
+        except KeyError:
+            self.snapshot = False
+
+        # validate the next 'depth' [todo] items while a job is imported
+        try:
+            lookahead = self.config["lookahead"]
+            self.lookahead_depth = lookahead.get("depth", 2)
+            self.lookahead_workers = lookahead.get("workers",
+                                                   self.lookahead_depth)
+            self.validator = SourceValidator(lookahead.get("min_size", 1),
+                                             lookahead.get("max_size"))
+        except KeyError:
+            self.validator = None
+
+        # copy the next 'depth' [todo] items on local storage
+        # - each profile uses its own sub-directory
+        try:
+            staging = self.config["staging"]
+            self.staging_depth = staging.get("depth", 1)
+            self.stager = Stager(os.path.join(staging["directory"],
+                                              self.alias),
+                                 self.logger,
+                                 staging.get("max_size"),
+                                 staging.get("workers", 1))
+        except KeyError:
+            self.stager = None
+
+        # look-ahead and staging only see the [todo] queue: items beyond
+        # the queue limit (a single one in 'snapshot' mode) aren't read
+        # in advance
+        queue_limit = 1 if self.snapshot else self.todo_queue_limit
+        if self.validator is not None and self.lookahead_depth > queue_limit:
+            self.logger.warning("lookahead.depth (%s) is above the [todo] "
+                                "queue limit (%s): only %s items are "
+                                "validated in advance", self.lookahead_depth,
+                                queue_limit, queue_limit - 1)
+        if self.stager is not None and self.staging_depth >= queue_limit:
+            self.logger.warning("staging.depth (%s) isn't below the [todo] "
+                                "queue limit (%s): only %s items are "
+                                "staged in advance", self.staging_depth,
+                                queue_limit, queue_limit - 1)
+
+        # import the objects changed since the last imported snapshot
+        # - the delta is used if its size is below 'max_ratio' of the file
+        self.index_file = os.path.join(state_dir,
+                                       self.config["alias"] + ".index")
+        try:
+            delta = self.config["delta"]
+            self.delta_extractor = DeltaExtractor(delta.get("id_attribute",
+                                                            "id"))
+            self.delta_max_ratio = delta.get("max_ratio", 0.5)
+        except KeyError:
+            self.delta_extractor = None
+
+        # compile the output parser rules once
+        try:
+            self.output_rules = compile_rules(self.config["output_parser"])
+        except KeyError:
+            self.output_rules = {}
+        except OutputParserError as e:
+            raise ProfileLoadError("output_parser: %s" % e)
+
+        # split the operations time into drush phases (opt-in)
+        # - the default markers are the drush 8 debug messages
+        try:
+            timing = self.config["timing"]
+            self.timing_markers = (
+                re.compile(timing.get("bootstrap_end", "^Found command")),
+                re.compile(timing.get("command_end",
+                                      "^Command dispatch complete")))
+            self.timing_keep_raw = timing.get("keep_raw", False)
+        except KeyError:
+            self.timing_markers = None
+        except re.error as e:
+            raise ProfileLoadError("timing: bad marker (%s)" % e)
+
+        # compile the source filter once
+        self.source_pattern = re.compile(self._source_filter())
+        self.logger.debug("==> filter is '%s'", self.source_pattern.pattern)
+
+        # profiles sharing the source directory scan it once
+        self.scanner = self._shared_scanner(config)
+
+    def set_targets(self, targets):
+        """
+        Set the drupal targets of the profile.
+
+        'targets' is a list of dict with the target 'name' and its
+        checked 'drupal' instance. Without targets the operations run
+        against the global drupal instance.
+        """
+        self.targets = targets
+
     def set_alerters(self, global_config):
         """Set alerters for the current profile."""
+        self.alerters = []
         try:
             for alerter in global_config["alert"]:
                 # get the handler and contruct the class name
@@ -167,18 +294,18 @@ class Profile(object):
                                                  _sender, _recipients,
                                                  _subject, _message, _headers))
 
-                            self.logger.debug("==> alerter '%s' was correcty initialize" %
+                            self.logger.debug("==> alerter '%s' was correcty initialize",
                                               alerter_class_id)
 
                         except KeyError as e:
-                            self.logger.error("AlertTransportMailConfigError(%s key error)" % e)
+                            self.logger.error("AlertTransportMailConfigError(%s key error)", e)
 
                 except KeyError as e:
-                    self.logger.warning("AlertTransportNotExists(%s)" %
+                    self.logger.warning("AlertTransportNotExists(%s)",
                                         alerter_handler)
 
         except KeyError as e:
-            self.logger.warning("no alert transport was found (%s)" % e)
+            self.logger.warning("no alert transport was found (%s)", e)
 
     def check_config_dir(self, directory):
         """
@@ -223,7 +350,7 @@ class Profile(object):
             json_data.close()
 
         except IOError:
-            self.logger.info("'%s' not found: an initial state file will be create" % \
+            self.logger.info("'%s' not found: an initial state file will be create",
                              self.state_file)
             data = {"timestamp": self.state_timestamp}
             with open(self.state_file, 'w') as out_file:
@@ -238,46 +365,127 @@ class Profile(object):
         For this we:
         - filter files into the 'src_dir' according to the param pattern
         - compare the current profile's state to the filename
+
+        In 'snapshot' mode see _queuing_snapshot().
+        The items left by an interrupted run are queued again.
         """
         try:
             src_dir = self.config["source"]["directory"]
-            # get the filter pattern
-            src_obj_filter = self._source_filter()
-            self.logger.debug("==> filter is '%s'" % src_obj_filter)
+            del self.todo_queue[:]
+            self.backlog_size = 0
+            self.source_object_files = 0
+
+            if self.snapshot:
+                return self._queuing_snapshot(src_dir)
 
             # put valid files into [todo] queue
             # items into queue are limited by the 'todo_queue_limit' parameter
-            self.logger.debug("==> todo queue limit is set to '%s'" %
+            self.logger.debug("==> todo queue limit is set to '%s'",
                               self.todo_queue_limit)
-            for f in sorted_ls(src_dir):
+            # - files beyond the limit are only counted in the backlog
+            for f in self._list_source(src_dir):
+                is_object_file = self.source_pattern.match(f)
+                if is_object_file is None:
+                    continue
+                if is_object_file.group(1) > self.state_timestamp:
+                    self.backlog_size += 1
                 if len(self.todo_queue) < self.todo_queue_limit:
-                    is_object_file = re.match(r'%s' % src_obj_filter, f)
-                    if is_object_file:
-                        self.source_object_files += 1
-                        if is_object_file.group(1) > self.state_timestamp:
-                            item = {"id": is_object_file.group(1),
-                                    "objects_filename": os.path.join(src_dir, f)}
-                            self.todo_queue.append(item)
+                    self.source_object_files += 1
+                    if is_object_file.group(1) > self.state_timestamp:
+                        item = {"id": is_object_file.group(1),
+                                "objects_filename": os.path.join(src_dir, f)}
+                        self.todo_queue.append(item)
 
             return len(self.todo_queue)
 
         except KeyError:
             raise ProfileError("no value found for source.directory")
 
-    def _source_filter(self):
-        """Return the filter pattern."""
-        param_id = self._detect_source_params()
-        cls_str = self._detect_source_param_class(param_id)
+    def _queuing_snapshot(self, src_dir):
+        """
+        Add the newest pending source 'objects' file into the [todo] queue.
+
+        The newest file having a 'config' file supersedes the older ones:
+        they are attached to its [todo] item and archived, without any
+        import, once it succeeded.
+        Newer files without 'config' file are left for the next run.
+        """
+        pending = []
+        for f in self._list_source(src_dir):
+            is_object_file = self.source_pattern.match(f)
+            if is_object_file is None:
+                continue
+            self.source_object_files += 1
+            if is_object_file.group(1) > self.state_timestamp:
+                pending.append({"id": is_object_file.group(1),
+                                "objects_filename": os.path.join(src_dir, f)})
+        self.backlog_size = len(pending)
+        if len(pending) == 0:
+            return 0
+
+        pending.sort(key=lambda item: item["id"])
+        newest = len(pending) - 1
+        for i in reversed(range(len(pending))):
+            if os.path.isfile(self._object_config_filename(pending[i])):
+                newest = i
+                break
+
+        item = pending[newest]
+        item["superseded"] = pending[:newest]
+        self.logger.debug("==> snapshot '%s' supersedes %s files",
+                          item["id"], len(item["superseded"]))
+        self.todo_queue.append(item)
+
+        return len(self.todo_queue)
+
+    def _shared_scanner(self, config):
+        """
+        Return the scanner of the shared source directory.
+
+        Return None if no other profile reads the directory.
+        """
+        src_dir = self.config["source"]["directory"]
+        patterns = {self.alias: self.source_pattern}
+        for profile in config.get_value("profiles"):
+            if (profile["alias"] == self.alias
+                    or profile["source"]["directory"] != src_dir):
+                continue
+            try:
+                patterns[profile["alias"]] = re.compile(
+                    self._source_filter(profile))
+            except (ProfileError, KeyError, AttributeError) as e:
+                self.logger.warning("profile '%s' isn't in the shared scan "
+                                    "(%s)", profile["alias"], e)
+        if len(patterns) == 1:
+            return None
+
+        return SourceScanner(os.path.join(config.get_value("state_dir"),
+                                          "scan"),
+                             src_dir, patterns, self.logger)
+
+    def _list_source(self, src_dir):
+        """Return the source files of the profile sorted by mtime."""
+        if self.scanner is None:
+            return sorted_ls(src_dir)
+
+        return self.scanner.matches(self.alias)
+
+    def _source_filter(self, config=None):
+        """Return the filter pattern (of the given profile 'config')."""
+        if config is None:
+            config = self.config
+        param_id = self._detect_source_params(config)
+        cls_str = self._detect_source_param_class(config, param_id)
         if cls_str is None:
             raise ProfileError("parameter '%s' isn't defined in config" %
                                param_id)
         else:
-            self.logger.debug("==> source objects class is '%s'" % cls_str)
+            self.logger.debug("==> source objects class is '%s'", cls_str)
             cls = globals()[cls_str]
-            instance = cls(param_id, "$", self.config["source"]["objects"])
+            instance = cls(param_id, "$", config["source"]["objects"])
             return instance.get_pattern()
 
-    def _detect_source_params(self):
+    def _detect_source_params(self, config):
         """
         Return the first parameter present into the source.objects definition.
 
@@ -287,7 +495,7 @@ class Profile(object):
         - hyphen character '-'
         If others parameters are present they are ignored
         """
-        src_obj_def = self.config["source"]["objects"]
+        src_obj_def = config["source"]["objects"]
         id_pattern = r"\w+\$([a-z_-]+)(\$.*)?\.xml"
         regex_id = re.match(r'%s' % id_pattern, src_obj_def)
         # strip the last character of the first parameter when
@@ -299,10 +507,10 @@ class Profile(object):
 
         return first_param
 
-    def _detect_source_param_class(self, param):
+    def _detect_source_param_class(self, config, param):
         """Return the class associated with the given param."""
-        if self.config["source"]["parameter"]["name"] == param:
-            return self.config["source"]["parameter"]["class"]
+        if config["source"]["parameter"]["name"] == param:
+            return config["source"]["parameter"]["class"]
         else:
             return None
 
@@ -315,39 +523,293 @@ class Profile(object):
           2. check if a config file is present for the [active] job
           3. set target symlinks
         """
-        self.logger.debug("==> %s files to process" % len(self.todo_queue))
-
+        self.logger.debug("==> %s files to process", len(self.todo_queue))
+        if self.validator is not None:
+            self.lookahead_pool = multiprocessing.pool.ThreadPool(
+                self.lookahead_workers)
+        if self.stager is not None:
+            self.stager.start()
+        try:
+            self._process_todo_q()
+        finally:
+            if self.lookahead_pool is not None:
+                self.lookahead_pool.close()
+                self.lookahead_pool.join()
+                self.lookahead_pool = None
+            if self.stager is not None:
+                self.stager.stop()
+
+        if not self.draining:
+            self.logger.info("all files has been processed")
+
+    def _process_todo_q(self):
+        """Processing loop of the [todo] queue."""
         while len(self.todo_queue) > 0:
+            # wait for a 'resume' and stop on 'drain' (control socket)
+            if not self.running.is_set():
+                self.logger.info("processing is paused")
+                self.running.wait()
+            if self.draining:
+                self.logger.info("processing drained: %s files left",
+                                 len(self.todo_queue))
+                break
+            if self.lease is not None and not self.lease.held:
+                self.logger.error("profile claim lost: %s files left",
+                                  len(self.todo_queue))
+                break
+            # broken files are quarantined before they take the [active] slot
+            if self.validator is not None and not self._lookahead():
+                continue
+            if self.stager is not None:
+                self._prefetch()
+
             if len(self.active_queue) == 0:
                 # add job to [active] queue...
                 self.active_queue.append(self.todo_queue.pop(0))
+                self.job_start_time = datetime.datetime.now()
                 job_id = self.active_queue[0]["id"]
+                # the job log directory holds the whole job log
+                reopen_logs(self.logger, job_id)
+                self._create_logdir(job_id)
                 # ...log his 'id'...
-                self.logger.info("[active/%s] processing file '%s'"
-                                  % (job_id,
-                                     self.active_queue[0]["objects_filename"]))
+                self.logger.info("[active/%s] processing file '%s'",
+                                 job_id,
+                                 self.active_queue[0]["objects_filename"])
                 # ...and process it
                 has_config, cfg_file = self._check_object_config()
                 if has_config:
-                    self.logger.debug("[active/%s] config file '%s' is present"
-                                      % (job_id,
-                                         cfg_file))
+                    self.logger.debug("[active/%s] config file '%s' is present",
+                                      job_id, cfg_file)
+                    if self.stager is not None:
+                        self._use_staged_files()
+                    if self.delta_extractor is not None:
+                        self._extract_delta()
                     self._set_target_symlinks()
                     self._run_operations()
                 else:
-                    self.logger.error("[active/%s] config file '%s' is absent"
-                                     % (job_id,
-                                        cfg_file))
+                    self.logger.error("[active/%s] config file '%s' is absent",
+                                      job_id, cfg_file)
                     self._send_alert("the configuration file is absent '%s'" %
                                      cfg_file)
+                    # the job is retried later: no log directory is kept
+                    flush_logs(self.logger, job_id)
+                    shutil.rmtree(self._create_logdir(job_id))
 
                 # remove the job from the [active] queue
-                self.active_queue = []
+                if self.stager is not None:
+                    self.stager.release(job_id)
+                self._complete_job()
             else:
                 raise ProfileProcessingError("only one job is permitted \
                                               in [active] queue")
 
-        self.logger.info("all files has been processed")
+    def _prefetch(self):
+        """
+        Stage the first [todo] items in the background.
+
+        The first item is the next job, the 'staging_depth' following
+        ones are copied while it is imported.
+        """
+        for item in self.todo_queue[:self.staging_depth + 1]:
+            self.stager.prefetch(item["id"],
+                                 [item["objects_filename"],
+                                  self._object_config_filename(item)])
+
+    def _use_staged_files(self):
+        """Set the staged copies of the [active] job files, if any."""
+        job = self.active_queue[0]
+        staged = self.stager.get(job["id"])
+        for t in ["objects", "config"]:
+            if job[t + "_filename"] in staged:
+                job["staged_" + t + "_filename"] = staged[job[t + "_filename"]]
+            else:
+                self.logger.warning("[active/%s] '%s' isn't staged",
+                                    job["id"], job[t + "_filename"])
+
+    def _extract_delta(self):
+        """
+        Extract the delta of the [active] job objects file.
+
+        The delta replaces the objects file if it is small enough. The new
+        objects index is kept once the job is imported.
+        """
+        job = self.active_queue[0]
+        objects_file = job.get("staged_objects_filename",
+                               job["objects_filename"])
+        name = os.path.basename(objects_file)
+        if name.endswith(".gz"):
+            name = name[:-3]
+        delta_file = os.path.join(self._create_logdir(job["id"]),
+                                  "delta_" + name)
+        try:
+            delta = self.delta_extractor.extract(objects_file,
+                                                 self.index_file,
+                                                 self.index_file + ".new",
+                                                 delta_file)
+        except (DeltaError, IOError, OSError) as e:
+            # without index, the next file is imported in full
+            self.logger.warning("[active/%s] no delta (%s)", job["id"], e)
+            if os.path.exists(self.index_file):
+                os.remove(self.index_file)
+            return
+        job["new_index_file"] = self.index_file + ".new"
+        if delta is None:
+            self.logger.info("[active/%s] no objects index: full import",
+                             job["id"])
+            return
+
+        delta_size = os.path.getsize(delta_file)
+        self.logger.info("[active/%s] delta: %s added, %s changed, "
+                         "%s removed (%s/%s bytes)", job["id"],
+                         delta["added"], delta["changed"], delta["removed"],
+                         delta_size, delta["size"])
+        if delta_size > delta["size"] * self.delta_max_ratio:
+            self.logger.info("[active/%s] delta is too big: full import",
+                             job["id"])
+            os.remove(delta_file)
+            return
+        job["delta_objects_filename"] = delta_file
+
+    def _lookahead(self):
+        """
+        Validate the next [todo] items in the background.
+
+        The validation of the 'lookahead_depth' next items runs in the
+        thread pool while the current job is imported. Items found broken
+        are quarantined.
+        Return False if the first [todo] item was quarantined.
+        """
+        for item in self.todo_queue[:self.lookahead_depth]:
+            if "validation" not in item:
+                item["validation"] = self.lookahead_pool.apply_async(
+                    self.validator.validate,
+                    (item["objects_filename"],
+                     self._object_config_filename(item)))
+
+        # the first item is the next job: wait for its validation
+        first = self.todo_queue[0]
+        first["validation"].wait()
+        for item in list(self.todo_queue):
+            validation = item.get("validation")
+            if validation is None or not validation.ready():
+                continue
+            error = validation.get()
+            if error is not None:
+                self.todo_queue.remove(item)
+                self._quarantine(item, error)
+
+        return len(self.todo_queue) > 0 and self.todo_queue[0] is first
+
+    def _quarantine(self, item, error):
+        """
+        Move a broken source pair into the quarantine directory.
+
+        Each quarantined pair has its own '<id>.<time>' sub-directory: a
+        file dropped again with the same name is quarantined again.
+        """
+        quarantine_dir = os.path.join(
+            self.log_dir, self.alias, "quarantine", "%s.%s" %
+            (item["id"], datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")))
+        self.logger.error("[todo/%s] quarantined: %s", item["id"], error)
+        try:
+            os.makedirs(quarantine_dir)
+            for f in [item["objects_filename"],
+                      self._object_config_filename(item)]:
+                if os.path.isfile(f):
+                    shutil.move(f, quarantine_dir)
+            with open(os.path.join(quarantine_dir, "error"), "w") as note:
+                note.write(error + "\n")
+        except (IOError, OSError, shutil.Error) as e:
+            # the item is left in the source directory
+            self.logger.error("[todo/%s] quarantine failed: %s",
+                              item["id"], e)
+            error = "%s (quarantine failed: %s)" % (error, e)
+        self.backlog_size = max(self.backlog_size - 1, 0)
+        if self.stager is not None:
+            self.stager.release(item["id"])
+        self._send_alert("source file '%s' quarantined: %s" %
+                         (item["objects_filename"], error))
+
+    def _complete_job(self):
+        """Remove the job from the [active] queue and record its duration."""
+        end_time = datetime.datetime.now()
+        self.completed_jobs.append(
+            {"id": self.active_queue[0]["id"],
+             "end_time": end_time,
+             "duration": (end_time - self.job_start_time).total_seconds()})
+        self.backlog_size = max(self.backlog_size - 1, 0)
+        self.active_queue = []
+        self.job_start_time = None
+
+    def inherit(self, profile):
+        """
+        Take over the processing status of the replaced 'profile'.
+
+        Used when the profile is rebuilt from a reloaded configuration.
+        """
+        self.completed_jobs = profile.completed_jobs
+        self.running = profile.running
+        self.draining = profile.draining
+        self.lease = profile.lease
+
+    def pause(self):
+        """Don't start the next job until resume() is called."""
+        self.logger.info("pause requested")
+        self.running.clear()
+
+    def resume(self):
+        """Resume the jobs processing."""
+        self.logger.info("resume requested")
+        self.running.set()
+
+    def drain(self):
+        """Stop processing once the current job is done."""
+        self.logger.info("drain requested")
+        self.draining = True
+        self.running.set()
+
+    def status(self):
+        """
+        Return the processing status of the profile.
+
+        Only in-memory informations are used: the source directory
+        is never read.
+        """
+        now = datetime.datetime.now()
+        status = {"profile": self.alias,
+                  "paused": not self.running.is_set(),
+                  "draining": self.draining,
+                  "active": None,
+                  "todo": [item["id"] for item in list(self.todo_queue)],
+                  "backlog_size": self.backlog_size,
+                  "throughput": None}
+
+        active_queue = list(self.active_queue)
+        job_start_time = self.job_start_time
+        if len(active_queue) > 0 and job_start_time is not None:
+            status["active"] = {
+                "id": active_queue[0]["id"],
+                "file": active_queue[0]["objects_filename"],
+                "operation": self.active_operation,
+                "targets": dict(self.target_operations),
+                "running_for": (now - job_start_time).total_seconds()}
+            operation_start_time = self.operation_start_time
+            if operation_start_time is not None:
+                status["active"]["operation_running_for"] = \
+                    (now - operation_start_time).total_seconds()
+
+        # throughput over the recently completed jobs
+        completed = list(self.completed_jobs)
+        if len(completed) > 0:
+            durations = [job["duration"] for job in completed]
+            mean_duration = sum(durations) / len(durations)
+            status["throughput"] = {
+                "completed_jobs": len(completed),
+                "last_job": completed[-1]["id"],
+                "mean_duration": mean_duration,
+                "jobs_per_hour": 3600 / mean_duration if mean_duration else None}
+
+        return status
 
     def _check_object_config(self):
         """
@@ -357,27 +819,38 @@ class Profile(object):
         - True if the file exists, else False
         - the absolute path of the 'config' file
         """
-        src_cfg_format = self.config["source"]["config"]
-
         job = self.active_queue[0]
-        src_cfg_file = os.path.join(os.path.dirname(job["objects_filename"]),
-                                    src_cfg_format.replace("$id", job["id"]))
+        src_cfg_file = self._object_config_filename(job)
         job["config_filename"] = src_cfg_file
 
         return os.path.isfile(src_cfg_file), src_cfg_file
 
+    def _object_config_filename(self, item):
+        """Return the absolute path of the 'config' file of a queue item."""
+        src_cfg_format = self.config["source"]["config"]
+
+        return os.path.join(os.path.dirname(item["objects_filename"]),
+                            src_cfg_format.replace("$id", item["id"]))
+
     def _set_target_symlinks(self):
-        """Set target symlinks to current active files (objects and config)."""
+        """
+        Set target symlinks to current active files (objects and config).
+
+        The delta or the staged copies of the files are used when present.
+        """
         try:
-            job_id = self.active_queue[0]["id"]
+            job = self.active_queue[0]
+            job_id = job["id"]
             tgt_dir = self.config["target"]["directory"]
             for t in ["objects", "config"]:
-                src = self.active_queue[0][t + "_filename"]
+                src = job.get("delta_" + t + "_filename",
+                              job.get("staged_" + t + "_filename",
+                                      job[t + "_filename"]))
                 tgt = os.path.join(tgt_dir, self.config["target"][t])
                 # force symlink creation
                 add_symlink(src, tgt, True)
-                self.logger.debug("[active/%s] set symlink: '%s' -> '%s'"
-                                  % (job_id, tgt, src))
+                self.logger.debug("[active/%s] set symlink: '%s' -> '%s'",
+                                  job_id, tgt, src)
 
         except KeyError:
             raise ProfileKeyError("no value for target.directory")
@@ -399,62 +872,268 @@ class Profile(object):
         job_id = job["id"]
         job_logdir = self._create_logdir(job_id)
 
-        for operation in self.config["operations"]:
-            self._acquire_lock(job_id + "," + operation)
-            self._run_operation(operation, job_logdir)
-            self._release_lock(job_id + "," + operation)
+        if len(self.targets) == 0:
+            for operation in self.config["operations"]:
+                self._check_lease()
+                self._acquire_lock(job_id + "," + operation)
+                self.active_operation = operation
+                self.operation_start_time = datetime.datetime.now()
+                self._run_operation(operation, job_logdir)
+                self.active_operation = None
+                self.operation_start_time = None
+                self._release_lock(job_id + "," + operation)
+        else:
+            self._run_targets_operations(job_logdir)
+
+        # operations summary, read by the history report
+        with open(os.path.join(job_logdir, "operations.json"), "w") as f:
+            json.dump(job.get("operations", {}), f, indent=4)
 
         files_to_archives = [job["objects_filename"], job["config_filename"]]
         self._archive_logs(job_logdir, files_to_archives)
-        self._update_state(job_id)
+        if self.snapshot:
+            superseded = job["superseded"]
+            self._update_state(job_id, [item["id"] for item in superseded])
+            # state is updated first: superseded files can't be queued again
+            self._archive_superseded(job_id, superseded)
+        else:
+            self._update_state(job_id)
+        # the next delta is computed against this file
+        if "new_index_file" in job:
+            os.rename(job["new_index_file"], self.index_file)
+
+    def _run_targets_operations(self, job_logdir):
+        """
+        Run the operations against all the targets at once.
+
+        Each target runs in its own thread, with its own lock file, log
+        sub-directory and state. A target that already imported the job
+        (previous failed run) is skipped.
+        Raise an exception if a target failed: the job isn't archived.
+        """
+        job = self.active_queue[0]
+        errors = []
+        threads = []
+        for target in self.targets:
+            if self._get_target_timestamp(target["name"]) == job["id"]:
+                self.logger.info("[active/%s] target '%s' already imported",
+                                 job["id"], target["name"])
+                continue
+            logdir = os.path.join(job_logdir, target["name"])
+            if not os.path.isdir(logdir):
+                os.makedirs(logdir)
+            thread = threading.Thread(target=self._run_target_operations,
+                                      args=(target, logdir, errors))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            raise ProfileProcessingError("target '%s' failed (%s)" %
+                                         errors[0])
+
+    def _run_target_operations(self, target, logdir, errors):
+        """Run the operations against one target (thread)."""
+        job_id = self.active_queue[0]["id"]
+        name = target["name"]
+        lock_file = self._target_lock_file(name)
+        try:
+            for operation in self.config["operations"]:
+                job_info = job_id + "," + name + "," + operation
+                self._check_lease()
+                self._acquire_lock(job_info, lock_file)
+                self.target_operations[name] = operation
+                try:
+                    self._run_operation(operation, logdir, target)
+                finally:
+                    self.target_operations.pop(name, None)
+                    self._release_lock(job_info, lock_file)
+            self._update_target_state(name, job_id)
+        except Exception as e:
+            self.logger.error("[active/%s] target '%s' failed: %s",
+                              job_id, name, e)
+            errors.append((name, e))
+
+    def _check_lease(self):
+        """Stop the job if the profile claim is lost (multi-node mode)."""
+        if self.lease is not None and not self.lease.held:
+            raise ProfileProcessingError("profile claim lost")
+
+    def _archive_superseded(self, job_id, superseded):
+        """Archive the files superseded by the 'job_id' snapshot."""
+        for item in superseded:
+            self.logger.info("[active/%s] archiving superseded file '%s'",
+                             job_id, item["objects_filename"])
+            logdir = self._create_logdir(item["id"])
+            with open(os.path.join(logdir, "superseded.log"), "w") as note:
+                note.write("superseded by '%s'\n" % job_id)
+            files = [item["objects_filename"]]
+            cfg_file = self._object_config_filename(item)
+            if os.path.isfile(cfg_file):
+                files.append(cfg_file)
+            self._archive_logs(logdir, files)
+            self.backlog_size = max(self.backlog_size - 1, 0)
 
     def _create_logdir(self, job_id):
         """Create and return the log directory for the given 'job_id'."""
         job_logdir = os.path.join(self.log_dir, self.alias, job_id)
         if not os.path.isdir(job_logdir):
-            self.logger.debug("creating log directory '%s'" % job_logdir)
             os.makedirs(job_logdir)
+            self.logger.debug("created log directory '%s'", job_logdir)
 
         return job_logdir
 
-    def _acquire_lock(self, job_info):
-        """Acquire the lock file."""
-        if os.path.exists(self.lock_file):
-            error_msg = "lock file '%s' already exists" % self.lock_file
+    def _acquire_lock(self, job_info, lock_file=None):
+        """Acquire the lock file (default is the profile lock file)."""
+        if lock_file is None:
+            lock_file = self.lock_file
+        if os.path.exists(lock_file):
+            error_msg = "lock file '%s' already exists" % lock_file
             self._send_alert(error_msg)
             raise ProfileProcessingError(error_msg)
         else:
-            f = open(self.lock_file, 'w')
+            f = open(lock_file, 'w')
             f.write(job_info)
             f.close()
-            self.logger.debug("lock acquire for '%s'" % job_info)
-
-    def _release_lock(self, job_info):
-        """Release the lock file."""
-        os.remove(self.lock_file)
-        self.logger.debug("lock release for '%s'" % job_info)
-
-    def _run_operation(self, operation, logdir):
+            self.logger.debug("lock acquire for '%s'", job_info)
+
+    def clear_stale_lock(self):
+        """Remove the lock files (profile and targets) left by a crashed node."""
+        lock_files = [self.lock_file] + [
+            self._target_lock_file(target["name"]) for target in self.targets]
+        for lock_file in lock_files:
+            if os.path.exists(lock_file):
+                with open(lock_file, "r") as f:
+                    job_info = f.read()
+                self.logger.warning("removing stale lock for '%s'", job_info)
+                os.remove(lock_file)
+
+    def _target_lock_file(self, target):
+        """Return the lock file of a target."""
+        return os.path.join(os.path.dirname(self.lock_file),
+                            "%s.%s.lock" % (self.alias, target))
+
+    def _release_lock(self, job_info, lock_file=None):
+        """Release the lock file (default is the profile lock file)."""
+        if lock_file is None:
+            lock_file = self.lock_file
+        os.remove(lock_file)
+        self.logger.debug("lock release for '%s'", job_info)
+
+    def _run_operation(self, operation, logdir, target=None):
         """
         Run the given operation.
 
-        Use drush binary.
+        Use drush binary, against the given 'target' or the global drupal
+        instance.
+        The operation first waits to be admitted by the admission
+        controller (if any).
+        In timing mode drush runs with '--debug' to split the operation
+        time into phases.
         """
-        op_start_time = datetime.datetime.now()
-        drush_cmd = subprocess.Popen([self.drupal.drush_bin,
-                                      "--root=" + self.drupal.root,
-                                      "--uri=" + self.drupal.uri,
-                                      "maps-import",
-                                      str(self.id),
-                                      "--op=" + operation],
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-        (drush_out, drush_err) = drush_cmd.communicate()
-        op_end_time = datetime.datetime.now()
-
+        if target is None:
+            drupal = self.drupal
+            target_name = None
+        else:
+            drupal = target["drupal"]
+            target_name = target["name"]
+        metrics = {}
+        if self.admission is not None:
+            metrics["admission_wait"] = self.admission.acquire()
+            self.logger.info("operation admitted after %.1fs",
+                             metrics["admission_wait"])
+        try:
+            drush_args = [drupal.drush_bin,
+                          "--root=" + drupal.root,
+                          "--uri=" + drupal.uri,
+                          "maps-import",
+                          str(self.id),
+                          "--op=" + operation]
+            if self.timing_markers is not None:
+                drush_args.insert(1, "--debug")
+            op_start_time = datetime.datetime.now()
+            drush_cmd = subprocess.Popen(drush_args,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+            parser = self._output_parser(operation)
+            if parser is None:
+                (drush_out, drush_err) = drush_cmd.communicate()
+            else:
+                (drush_out, drush_err) = self._parse_output(drush_cmd, parser)
+            op_end_time = datetime.datetime.now()
+        finally:
+            if self.admission is not None:
+                self.admission.release()
+
+        if parser is not None:
+            metrics["output"] = parser.metrics(
+                (op_end_time - op_start_time).total_seconds())
+            self.logger.info("%s objects processed (%s/s)",
+                             metrics["output"]["objects"],
+                             metrics["output"]["objects_per_second"])
+        if self.timing_markers is not None:
+            (metrics["timing"], drush_err) = self._split_timing(
+                operation, logdir, drush_err,
+                (op_end_time - op_start_time).total_seconds())
         self._log_operation(operation, logdir,
                             drush_out, drush_err)
-        self._update_operation_state(operation, op_start_time, op_end_time)
+        self._update_operation_state(operation, op_start_time, op_end_time,
+                                     metrics, target_name)
+
+    def _output_parser(self, operation):
+        """Return an output parser for the operation, None if no rules."""
+        try:
+            return OutputParser(self.output_rules[operation])
+        except KeyError:
+            pass
+        try:
+            return OutputParser(self.output_rules["default"])
+        except KeyError:
+            return None
+
+    def _parse_output(self, drush_cmd, parser):
+        """
+        Feed the parser with the drush output as it streams.
+
+        stderr is read in a thread to avoid a pipe deadlock.
+        Return the complete stdout and stderr.
+        """
+        stderr = []
+        stderr_reader = threading.Thread(
+            target=lambda: stderr.append(drush_cmd.stderr.read()))
+        stderr_reader.start()
+        stdout = []
+        for line in iter(drush_cmd.stdout.readline, ""):
+            stdout.append(line)
+            parser.feed(line)
+        drush_cmd.wait()
+        stderr_reader.join()
+
+        return "".join(stdout), "".join(stderr)
+
+    def _split_timing(self, operation, logdir, stderr, duration):
+        """
+        Return the phases of the operation and the drush errors.
+
+        The debug lines are removed from the errors, they are kept in
+        '<operation>-timing.log' with 'keep_raw'.
+        """
+        timing = TimingParser(*self.timing_markers)
+        (debug, stderr) = timing.split(stderr)
+        if self.timing_keep_raw:
+            with open(os.path.join(logdir, operation + "-timing.log"),
+                      "w") as f:
+                f.write(debug)
+        phases = timing.phases(duration)
+        if phases is None:
+            self.logger.warning("no timing markers in the drush output")
+        else:
+            self.logger.info("bootstrap %.2fs, command %.2fs, "
+                             "shutdown %.2fs", phases["bootstrap"],
+                             phases["command"], phases["shutdown"])
+
+        return phases, stderr
 
     def _log_operation(self, operation, logdir, stdout, stderr):
         """Log the operations results."""
@@ -463,25 +1142,47 @@ class Profile(object):
         log_file = os.path.join(logdir, operation + ".log")
         err_file = os.path.join(logdir, operation + "-err.log")
         # always log stdout
-        self.logger.info("complete informations in '%s'" % log_file)
+        self.logger.info("complete informations in '%s'", log_file)
         log = open(log_file, "w")
         log.write(stdout)
         log.close()
         # only log if there is errors
         if stderr is not "":
-            self.logger.warning("errors are logged in '%s'" % err_file)
+            self.logger.warning("errors are logged in '%s'", err_file)
             err = open(err_file, "w")
             err.write(stderr)
             err.close()
 
-    def _update_operation_state(self, operation, start_time, end_time):
-        """Update the operation state in global profile state."""
-        self.logger.info("updating '%s' operation in profile state" %
+    def _update_operation_state(self, operation, start_time, end_time,
+                                metrics=None, target=None):
+        """
+        Update the operation state in global profile state.
+
+        Additionnal 'metrics' are stored with the operation times.
+        The operations of a 'target' are stored in its own state
+        ('targets' object).
+        """
+        self.logger.info("updating '%s' operation in profile state",
                          operation)
+        self.state_lock.acquire()
+        try:
+            self._write_operation_state(operation, start_time, end_time,
+                                        metrics, target)
+        finally:
+            self.state_lock.release()
+
+    def _write_operation_state(self, operation, start_time, end_time,
+                               metrics, target):
+        """Write the operation state (state lock held)."""
         # get current profile state ...
         with open(self.state_file, "r") as json_current:
-            state = json.load(json_current)
+            profile_state = json.load(json_current)
             json_current.close()
+        if target is None:
+            state = profile_state
+        else:
+            state = profile_state.setdefault("targets", {}).setdefault(
+                target, {})
         # ..., create "succeded_operations" object if not exists...
         try:
             _ = state["succeded_operations"]
@@ -500,18 +1201,48 @@ class Profile(object):
         op_status["start_time"] = start_time_iso8601
         op_status["end_time"] = end_time_iso8601
         op_status["duration"] = str(end_time-start_time)
+        op_status["seconds"] = (end_time-start_time).total_seconds()
         op_status["file"] = self.active_queue[0]["objects_filename"]
+        if metrics is not None:
+            op_status.update(metrics)
         state["succeded_operations"][operation] = op_status
+        if target is not None:
+            operation = target + "/" + operation
+        self.active_queue[0].setdefault("operations", {})[operation] = \
+            op_status
         # write to file
         with open(self.state_file, 'w') as out_file:
-            json.dump(state, out_file, indent=4)
+            json.dump(profile_state, out_file, indent=4)
         out_file.close()
 
-    def _update_state(self, job_id):
+    def _get_target_timestamp(self, target):
+        """Return the timestamp of the last job imported in 'target'."""
+        with open(self.state_file, "r") as json_current:
+            state = json.load(json_current)
+        try:
+            return state["targets"][target]["timestamp"]
+        except KeyError:
+            return "0"
+
+    def _update_target_state(self, target, job_id):
+        """Update the timestamp of 'target' once all its operations ran."""
+        self.state_lock.acquire()
+        try:
+            with open(self.state_file, "r") as json_current:
+                state = json.load(json_current)
+            state.setdefault("targets", {}).setdefault(
+                target, {})["timestamp"] = job_id
+            with open(self.state_file, "w") as json_new:
+                json.dump(state, json_new, indent=4)
+        finally:
+            self.state_lock.release()
+
+    def _update_state(self, job_id, superseded=None):
         """
         Update the timestamp in the profile state file.
 
         This action only occurred when all the operations succeded.
+        In 'snapshot' mode the ids of the skipped files are also stored.
         """
         self.logger.info("updating 'timestamp' in profile state")
         # get current state ...
@@ -521,6 +1252,8 @@ class Profile(object):
         # ... and write new timestamp
         with open(self.state_file, "w") as json_new:
             state["timestamp"] = job_id
+            if superseded is not None:
+                state["superseded"] = superseded
             json.dump(state, json_new, indent=4)
             json_new.close()
 
@@ -532,11 +1265,12 @@ class Profile(object):
 
         # move files into logdir for archive
         for f in files:
-            self.logger.info("moving '%s' to archive folder" % f)
+            self.logger.info("moving '%s' to archive folder", f)
             shutil.move(f, logdir)
 
         # move to logdir parent folder
-        self.logger.info("archiving profile logs into '%s'" % archive_file)
+        self.logger.info("archiving profile logs into '%s'", archive_file)
+        flush_logs(self.logger, os.path.basename(logdir))
         os.chdir(archive_wd)
         archive = tarfile.open(archive_file, "w:gz")
         archive.add(os.path.basename(logdir))
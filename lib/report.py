@@ -0,0 +1,239 @@
+"""Run history report."""
+import datetime
+import json
+import os
+import tarfile
+import time
+
+
+# columns of the history, one value per operation run
+COLUMNS = ["job_id", "operation", "end_time", "duration", "objects",
+           "estimated"]
+
+
+def percentile(values, p):
+    """Return the 'p' percentile of the sorted 'values' (interpolated)."""
+    if len(values) == 0:
+        return None
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def format_seconds(value):
+    """Format a duration in seconds."""
+    if value is None:
+        return "-"
+
+    return "%.1fs" % value
+
+
+class History(object):
+
+    """
+    Columnar run history of a profile.
+
+    The history is built from the archived '<job_id>.tgz' logs and cached
+    in '<state_dir>/<alias>.history.json'. Only the archives added since
+    the last build are read.
+    """
+
+    def __init__(self, state_dir, log_dir, alias, operations):
+        """Constructor."""
+        self.alias = alias
+        self.operations = operations
+        self.archive_dir = os.path.join(log_dir, alias)
+        self.cache_file = os.path.join(state_dir, alias + ".history.json")
+        self.archives = {}
+        self.columns = dict((column, []) for column in COLUMNS)
+
+    def load(self):
+        """Load the cached history."""
+        try:
+            with open(self.cache_file, "r") as f:
+                cache = json.load(f)
+            self.archives = cache["archives"]
+            self.columns = cache["columns"]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        """Write the history cache."""
+        with open(self.cache_file, "w") as f:
+            json.dump({"archives": self.archives, "columns": self.columns}, f)
+
+    def update(self):
+        """Add the new archives to the history, return their number."""
+        if not os.path.isdir(self.archive_dir):
+            return 0
+        added = 0
+        for f in sorted(os.listdir(self.archive_dir)):
+            if not f.endswith(".tgz"):
+                continue
+            archive_file = os.path.join(self.archive_dir, f)
+            size = os.path.getsize(archive_file)
+            if self.archives.get(f) == size:
+                continue
+            try:
+                rows = self._read_archive(archive_file, f[:-4])
+            except (tarfile.TarError, IOError, ValueError):
+                continue
+            # an archive rewritten with the same job id replaces its rows
+            if f in self.archives:
+                self._remove_job(f[:-4])
+            for row in rows:
+                for column in COLUMNS:
+                    self.columns[column].append(row.get(column))
+            self.archives[f] = size
+            added += 1
+
+        return added
+
+    def rows(self):
+        """Return the history rows sorted by end time."""
+        rows = [dict((column, self.columns[column][i]) for column in COLUMNS)
+                for i in range(len(self.columns["job_id"]))]
+
+        return sorted(rows, key=lambda row: row["end_time"])
+
+    def _remove_job(self, job_id):
+        """Remove the rows of 'job_id'."""
+        keep = [i for i, value in enumerate(self.columns["job_id"])
+                if value != job_id]
+        for column in COLUMNS:
+            self.columns[column] = [self.columns[column][i] for i in keep]
+
+    def _read_archive(self, archive_file, job_id):
+        """
+        Return the operations rows of an archive.
+
+        The 'operations.json' summary is used when present. Older archives
+        only have the operations logs: their durations are estimated from
+        the logs modification times, the first operation is then unknown.
+        """
+        summary = None
+        log_mtimes = {}
+        archive = tarfile.open(archive_file, "r:gz")
+        try:
+            for member in archive:
+                name = os.path.basename(member.name)
+                if name == "operations.json":
+                    summary = json.load(archive.extractfile(member))
+                elif name.endswith(".log") and name[:-4] in self.operations:
+                    log_mtimes[name[:-4]] = member.mtime
+        finally:
+            archive.close()
+
+        rows = []
+        if summary is not None:
+            for operation, status in summary.items():
+                output = status.get("output") or {}
+                rows.append({"job_id": job_id,
+                             "operation": operation,
+                             "end_time": self._timestamp(status["end_time"]),
+                             "duration": status["seconds"],
+                             "objects": output.get("objects"),
+                             "estimated": 0})
+            return rows
+
+        previous = None
+        for operation, mtime in sorted(log_mtimes.items(),
+                                       key=lambda item: item[1]):
+            if previous is not None:
+                rows.append({"job_id": job_id,
+                             "operation": operation,
+                             "end_time": mtime,
+                             "duration": mtime - previous,
+                             "objects": None,
+                             "estimated": 1})
+            previous = mtime
+
+        return rows
+
+    def _timestamp(self, iso8601):
+        """Convert a state (local) time to a unix timestamp."""
+        date = datetime.datetime.strptime(iso8601, "%Y-%m-%dT%H:%M:%S.%f")
+
+        return time.mktime(date.timetuple()) + date.microsecond / 1e6
+
+
+class Report(object):
+
+    """Durations percentiles, trends and outliers of a history."""
+
+    percentiles = [50, 90, 95, 99]
+
+    def __init__(self, history, trend_window=20, outliers=5):
+        """Constructor."""
+        self.history = history
+        self.trend_window = trend_window
+        self.outliers = outliers
+
+    def render(self):
+        """Return the report lines."""
+        rows = self.history.rows()
+        jobs = set(row["job_id"] for row in rows)
+        lines = ["profile '%s': %s jobs" % (self.history.alias, len(jobs))]
+        operations = sorted(set(row["operation"] for row in rows))
+        for operation in operations:
+            op_rows = [row for row in rows if row["operation"] == operation]
+            lines.extend(self._render_operation(operation, op_rows))
+
+        return lines
+
+    def _render_operation(self, operation, rows):
+        """Return the report lines of one operation."""
+        durations = sorted(row["duration"] for row in rows)
+        stats = ["n=%s" % len(durations),
+                 "mean=%s" % format_seconds(float(sum(durations)) /
+                                           len(durations))]
+        for p in self.percentiles:
+            stats.append("p%s=%s" % (p, format_seconds(percentile(durations,
+                                                                   p))))
+        stats.append("max=%s" % format_seconds(durations[-1]))
+        lines = ["  %s: %s" % (operation, " ".join(stats))]
+
+        # trend: median of the last jobs against the previous ones
+        last = sorted(row["duration"] for row in rows[-self.trend_window:])
+        previous = sorted(row["duration"] for row in
+                          rows[-2 * self.trend_window:-self.trend_window])
+        if len(previous) > 0:
+            last_p50 = percentile(last, 50)
+            previous_p50 = percentile(previous, 50)
+            change = ""
+            if previous_p50 > 0:
+                change = " (%+.0f%%)" % ((last_p50 / previous_p50 - 1) * 100)
+            lines.append("    trend: p50 %s over the last %s runs, %s before%s"
+                         % (format_seconds(last_p50), len(last),
+                            format_seconds(previous_p50), change))
+
+        # monthly percentiles
+        months = {}
+        for row in rows:
+            month = datetime.datetime.fromtimestamp(
+                row["end_time"]).strftime("%Y-%m")
+            months.setdefault(month, []).append(row["duration"])
+        for month in sorted(months):
+            values = sorted(months[month])
+            lines.append("    %s: n=%s p50=%s p95=%s" %
+                         (month, len(values),
+                          format_seconds(percentile(values, 50)),
+                          format_seconds(percentile(values, 95))))
+
+        # outliers: beyond the median + 3 median absolute deviations
+        # and 50% slower than the median
+        median = percentile(durations, 50)
+        mad = percentile(sorted(abs(d - median) for d in durations), 50)
+        if mad > 0:
+            threshold = max(median + 3 * mad, median * 1.5)
+            outliers = [row for row in rows if row["duration"] > threshold]
+            outliers.sort(key=lambda row: row["duration"], reverse=True)
+            if len(outliers) > 0:
+                lines.append("    outliers: " + ", ".join(
+                    "%s (%s)" % (row["job_id"],
+                                 format_seconds(row["duration"]))
+                    for row in outliers[:self.outliers]))
+
+        return lines
@@ -0,0 +1,104 @@
+"""Source scanner class."""
+import hashlib
+import json
+import os
+import re
+import time
+
+
+class SourceScanner(object):
+
+    """
+    Scan a source directory once for all the profiles reading it.
+
+    The directory is listed once and each filename is tested against the
+    combined patterns of the profiles, the matches of every profile are
+    cached in '<cache_dir>/<md5 of the directory>.json'. The next runs of
+    the profiles use the cache until the directory changes (modification
+    time).
+    """
+
+    def __init__(self, cache_dir, directory, patterns, logger):
+        """
+        Constructor.
+
+        'patterns' is a dict profile alias -> compiled source pattern.
+        """
+        self.directory = directory
+        self.patterns = patterns
+        self.logger = logger
+        self.cache_file = os.path.join(
+            cache_dir, hashlib.md5(directory).hexdigest() + ".json")
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def matches(self, alias):
+        """Return the files of the 'alias' profile sorted by mtime."""
+        scan = self._load()
+        if scan is None:
+            scan = self._scan()
+            self._save(scan)
+        else:
+            self.logger.debug("==> '%s' listing read from the scan cache",
+                              self.directory)
+
+        return scan["matches"][alias]
+
+    def _signature(self):
+        """Return the patterns of the scan, a cache is for one set."""
+        return dict((alias, pattern.pattern)
+                    for alias, pattern in self.patterns.items())
+
+    def _load(self):
+        """Return the cached scan, None if it is absent or outdated."""
+        try:
+            with open(self.cache_file, "r") as f:
+                scan = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if scan.get("patterns") != self._signature():
+            return None
+        # a directory changed in the second of the scan may have changed
+        # after the listing with the same mtime
+        if scan["mtime"] >= scan["scan_time"] - 1:
+            return None
+        if os.stat(self.directory).st_mtime != scan["mtime"]:
+            return None
+
+        return scan
+
+    def _save(self, scan):
+        """Write the scan cache (atomic rename)."""
+        tmp_file = "%s.%s" % (self.cache_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump(scan, f)
+        os.rename(tmp_file, self.cache_file)
+
+    def _scan(self):
+        """List the directory and dispatch the files to the profiles."""
+        scan_time = time.time()
+        mtime = os.stat(self.directory).st_mtime
+        combined = re.compile("|".join("(?:%s)" % pattern.pattern
+                                       for pattern in self.patterns.values()))
+        matches = dict((alias, []) for alias in self.patterns)
+        mtimes = {}
+        for f in os.listdir(self.directory):
+            if combined.match(f) is None:
+                continue
+            try:
+                mtimes[f] = os.stat(os.path.join(self.directory, f)).st_mtime
+            except OSError:
+                # removed since the listing
+                continue
+            for alias, pattern in self.patterns.items():
+                if pattern.match(f) is not None:
+                    matches[alias].append(f)
+        for files in matches.values():
+            files.sort(key=lambda f: mtimes[f])
+        self.logger.debug("==> '%s' scanned for %s profiles",
+                          self.directory, len(self.patterns))
+
+        return {"mtime": mtime,
+                "scan_time": scan_time,
+                "patterns": self._signature(),
+                "matches": matches}
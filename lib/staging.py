@@ -0,0 +1,144 @@
+"""Source staging class."""
+import errno
+import gzip
+import multiprocessing.pool
+import os
+import shutil
+import struct
+import threading
+
+
+class Stager(object):
+
+    """
+    Copy the queued source files to a fast local directory.
+
+    Files are copied in background threads while the current job runs,
+    '.gz' files are decompressed. The disk usage of the staging directory
+    is capped to 'max_size' bytes: a file that doesn't fit isn't staged
+    and the source file is used instead.
+    The staging directory is only touched by the process running the
+    profile, from start().
+    """
+
+    chunk_size = 1048576
+
+    def __init__(self, directory, logger, max_size=None, workers=1):
+        """Constructor."""
+        self.directory = directory
+        self.logger = logger
+        self.max_size = max_size
+        self.workers = workers
+        self.pool = None
+        self.usage = 0
+        self.lock = threading.Lock()
+        self.staged = {}
+
+    def start(self):
+        """Remove the files left by a previous run, start the copy threads."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for f in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, f))
+        self.pool = multiprocessing.pool.ThreadPool(self.workers)
+
+    def stop(self):
+        """Wait for the copies and remove all the staged files."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for key in list(self.staged):
+            self.release(key)
+
+    def prefetch(self, key, files):
+        """Stage the 'files' of the 'key' item in the background."""
+        if key not in self.staged:
+            self.staged[key] = self.pool.apply_async(self._stage, (files,))
+
+    def get(self, key):
+        """
+        Wait for the 'key' item and return its staged files.
+
+        Return a dict source filename -> staged filename, files that
+        couldn't be staged are absent.
+        """
+        return dict((src, dest) for src, (dest, size)
+                    in self.staged[key].get().items())
+
+    def release(self, key):
+        """Remove the staged files of the 'key' item."""
+        result = self.staged.pop(key, None)
+        if result is None:
+            return
+        for staged_file, size in result.get().values():
+            try:
+                os.remove(staged_file)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            with self.lock:
+                self.usage -= size
+
+    def _stage(self, files):
+        """Copy the files, return the staged files and their sizes."""
+        staged = {}
+        for src in files:
+            if not os.path.isfile(src):
+                continue
+            try:
+                size = self._staged_size(src)
+            except (IOError, OSError, struct.error) as e:
+                self.logger.warning("'%s' not staged (%s)", src, e)
+                continue
+            with self.lock:
+                if (self.max_size is not None
+                        and self.usage + size > self.max_size):
+                    self.logger.warning("staging is full: '%s' not staged",
+                                        src)
+                    continue
+                self.usage += size
+            try:
+                staged[src] = (self._copy(src), size)
+            except (IOError, OSError) as e:
+                self.logger.warning("'%s' not staged (%s)", src, e)
+                with self.lock:
+                    self.usage -= size
+
+        return staged
+
+    def _staged_size(self, src):
+        """
+        Return the size of the staged file.
+
+        The uncompressed size of a gzip file is stored in its last 4 bytes
+        (modulo 2^32).
+        """
+        if not src.endswith(".gz"):
+            return os.path.getsize(src)
+        with open(src, "rb") as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack("<I", f.read(4))[0]
+
+    def _copy(self, src):
+        """Copy (and decompress) 'src' into the staging directory."""
+        name = os.path.basename(src)
+        if name.endswith(".gz"):
+            name = name[:-3]
+            src_file = gzip.open(src, "rb")
+        else:
+            src_file = open(src, "rb")
+        dest = os.path.join(self.directory, name)
+        tmp_dest = dest + ".part"
+        try:
+            with open(tmp_dest, "wb") as dest_file:
+                shutil.copyfileobj(src_file, dest_file, self.chunk_size)
+        except (IOError, OSError):
+            if os.path.exists(tmp_dest):
+                os.remove(tmp_dest)
+            raise
+        finally:
+            src_file.close()
+        os.rename(tmp_dest, dest)
+
+        return dest
@@ -0,0 +1,76 @@
+"""Source validator class."""
+import gzip
+import os
+import xml.parsers.expat
+
+
+class SourceValidationError(Exception):
+
+    """Invalid source file exception."""
+
+    pass
+
+
+class SourceValidator(object):
+
+    """
+    Check a queued source pair ('objects' and 'config' files).
+
+    - the 'config' file exists
+    - the 'objects' file size is between 'min_size' and 'max_size' bytes
+    - both files are well formed XML (streaming parse: the whole file is
+      never loaded, a wrong encoding is reported as malformed)
+    '.gz' files are decompressed on the fly.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, min_size=1, max_size=None):
+        """Constructor."""
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def validate(self, objects_file, config_file):
+        """Return the error message of the pair, None if it is valid."""
+        try:
+            if not os.path.isfile(config_file):
+                raise SourceValidationError("config file '%s' is absent" %
+                                            config_file)
+            self._check_size(objects_file)
+            self._check_xml(config_file)
+            self._check_xml(objects_file)
+        except SourceValidationError as e:
+            return str(e)
+        except (IOError, OSError) as e:
+            return "can't read source file (%s)" % e
+
+        return None
+
+    def _check_size(self, filename):
+        """Check that the file size is sane."""
+        size = os.path.getsize(filename)
+        if size < self.min_size:
+            raise SourceValidationError("'%s' is too small (%s bytes)" %
+                                        (filename, size))
+        if self.max_size is not None and size > self.max_size:
+            raise SourceValidationError("'%s' is too big (%s bytes)" %
+                                        (filename, size))
+
+    def _check_xml(self, filename):
+        """Check that the file is well formed XML."""
+        parser = xml.parsers.expat.ParserCreate()
+        try:
+            if filename.endswith(".gz"):
+                f = gzip.open(filename, "rb")
+            else:
+                f = open(filename, "rb")
+            with f:
+                while True:
+                    data = f.read(self.chunk_size)
+                    if not data:
+                        break
+                    parser.Parse(data, False)
+            parser.Parse("", True)
+        except xml.parsers.expat.ExpatError as e:
+            raise SourceValidationError("'%s' isn't well formed XML (%s)" %
+                                        (filename, e))